@@ -1,21 +1,45 @@
 import os
 import time
 import psycopg2
-from psycopg2 import pool, extras
+from psycopg2 import pool, extras, extensions
 from datetime import datetime, timedelta
-from flask import Flask, render_template, request, redirect, url_for, flash, make_response, session, jsonify
+from flask import (Flask, render_template, request, redirect, url_for, flash, make_response, session, jsonify, g,
+                   has_request_context, Response, stream_with_context, send_file, get_flashed_messages)
 from weasyprint import HTML
 from decimal import Decimal, InvalidOperation
 import qrcode
 import base64
-from io import BytesIO
+from io import BytesIO, StringIO
 from contextlib import contextmanager
 from werkzeug.security import generate_password_hash, check_password_hash
 from functools import wraps
 from dotenv import load_dotenv
+from jinja2 import FileSystemBytecodeCache, nodes
+from jinja2.ext import Extension
+try:
+    import openpyxl  # Optional: only needed for Excel student imports
+except ImportError:
+    openpyxl = None
 import logging
+import logging.handlers
+import atexit
+import copy
+import click
 import sys
 import random  # Add this with your other imports
+import json
+import re
+import threading
+import queue
+import cProfile
+import pstats
+import uuid
+import hashlib
+import hmac
+import csv
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+from collections import Counter, OrderedDict, deque
 # Load environment variables
 load_dotenv()
 
@@ -23,15 +47,140 @@ load_dotenv()
 app = Flask(__name__)
 app.secret_key = os.getenv('FLASK_SECRET_KEY', 'default-secret-key')
 
-# Configure logging
-logging.basicConfig(level=logging.INFO)
+# Configure logging: callers only enqueue records, a listener thread formats and writes them
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
+LOG_FORMAT = os.getenv('LOG_FORMAT', 'json').lower()  # 'json' lines or plain 'text'
+LOG_FILE = os.getenv('LOG_FILE', '')  # Empty logs to stderr
+LOG_QUEUE_SIZE = int(os.getenv('LOG_QUEUE_SIZE', 10000))
+# Fraction of per-student balance updates that are logged; warnings and errors are always kept
+BALANCE_LOG_SAMPLE_RATE = float(os.getenv('BALANCE_LOG_SAMPLE_RATE', 1.0))
+
+LOG_CONTEXT_FIELDS = ('route', 'path', 'student_id', 'duration_ms', 'query_count')
+
+log_queue = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+log_listener = None
+
+class RequestContextFilter(logging.Filter):
+    """Copy request fields onto the record while still in the request thread"""
+    def filter(self, record):
+        if not has_request_context():
+            return True
+        if getattr(record, 'route', None) is None:
+            record.route = request.endpoint
+        if getattr(record, 'path', None) is None:
+            record.path = request.path
+        if getattr(record, 'student_id', None) is None and request.view_args:
+            record.student_id = request.view_args.get('student_id')
+        started = g.get('request_started')
+        if started is not None:
+            record.duration_ms = round((time.perf_counter() - started) * 1000, 1)
+        stats = g.get('query_stats')
+        if stats is not None:
+            record.query_count = stats['queries']
+        return True
+
+class SampleFilter(logging.Filter):
+    """Keep a random fraction of records below WARNING"""
+    def __init__(self, rate):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record):
+        return record.levelno >= logging.WARNING or self.rate >= 1 or random.random() < self.rate
+
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    """Queue records without ever waiting; when the queue is full they are dropped and counted"""
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        # Resolve the message and traceback here so the record no longer references live objects
+        record = copy.copy(record)
+        record.message = record.getMessage()
+        record.msg = record.message
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            if self.dropped:
+                dropped, self.dropped = self.dropped, 0
+                self.queue.put_nowait(logging.makeLogRecord({
+                    'name': __name__, 'levelno': logging.WARNING, 'levelname': 'WARNING',
+                    'msg': f"Log queue full, dropped {dropped} records"
+                }))
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+class JsonLogFormatter(logging.Formatter):
+    """One JSON object per line"""
+    def format(self, record):
+        entry = {
+            'time': datetime.fromtimestamp(record.created).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage()
+        }
+        for field in LOG_CONTEXT_FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                entry[field] = value
+        if record.exc_text:
+            entry['exception'] = record.exc_text
+        return json.dumps(entry, default=str)
+
+def stop_logging():
+    """Flush queued records on shutdown"""
+    global log_listener
+    listener, log_listener = log_listener, None
+    if listener is not None:
+        try:
+            listener.stop()
+        except queue.Full:
+            pass
+
+def configure_logging():
+    global log_listener
+    if LOG_FILE:
+        output = logging.handlers.WatchedFileHandler(LOG_FILE)
+    else:
+        output = logging.StreamHandler(sys.stderr)
+    if LOG_FORMAT == 'json':
+        output.setFormatter(JsonLogFormatter())
+    else:
+        output.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(name)s: %(message)s'))
+
+    handler = NonBlockingQueueHandler(log_queue)
+    handler.addFilter(RequestContextFilter())
+    root = logging.getLogger()
+    root.handlers = [handler]
+    root.setLevel(LOG_LEVEL)
+
+    log_listener = logging.handlers.QueueListener(log_queue, output)
+    log_listener.start()
+    atexit.register(stop_logging)
+
+configure_logging()
 logger = logging.getLogger(__name__)
+# High-volume per-student balance messages, sampled by BALANCE_LOG_SAMPLE_RATE
+balance_logger = logging.getLogger(f'{__name__}.balances')
+balance_logger.addFilter(SampleFilter(BALANCE_LOG_SAMPLE_RATE))
 
 # Database connection pool
 db_pool = None
+database_url = None
+replica_pool = None
+DATABASE_SSLMODE = os.getenv('DATABASE_SSLMODE', 'require')
+# Offline cashier mode: payments are taken on local SQLite while Postgres is unreachable
+OFFLINE_CASHIER = os.getenv('OFFLINE_CASHIER', '').lower() in ('1', 'true', 'yes')
 
 def init_db_pool():
-    global db_pool
+    global db_pool, database_url
     max_retries = 5
     retry_delay = 2
     
@@ -48,10 +197,13 @@ def init_db_pool():
                 minconn=1,
                 maxconn=10,
                 dsn=DATABASE_URL,
-                sslmode='require'
+                sslmode=DATABASE_SSLMODE,
+                connection_factory=PreparedStatementConnection
             )
+            database_url = DATABASE_URL
             logger.info("✅ Database connection established")
             init_db()
+            init_replica_pool()
             return
         except Exception as e:
             logger.error(f"❌ Attempt {attempt + 1} failed: {str(e)}")
@@ -59,8 +211,34 @@ def init_db_pool():
                 time.sleep(retry_delay)
             else:
                 logger.error("❌ Failed to connect to database after multiple attempts")
+                if OFFLINE_CASHIER:
+                    logger.warning("Starting in offline cashier mode; payments will queue locally")
+                    return
                 raise
 
+def init_replica_pool():
+    """Open the optional read-only pool used for report and listing queries"""
+    global replica_pool
+    REPLICA_URL = os.getenv('DATABASE_REPLICA_URL')
+    if not REPLICA_URL:
+        return
+    
+    if REPLICA_URL.startswith('postgres://'):
+        REPLICA_URL = REPLICA_URL.replace('postgres://', 'postgresql://', 1)
+    
+    try:
+        replica_pool = pool.ThreadedConnectionPool(
+            minconn=1,
+            maxconn=int(os.getenv('REPLICA_POOL_MAX', 10)),
+            dsn=REPLICA_URL,
+            sslmode=DATABASE_SSLMODE,
+            connection_factory=PreparedStatementConnection
+        )
+        logger.info("✅ Read replica connection established")
+    except Exception as e:
+        logger.error(f"❌ Read replica unavailable, reads will use the primary: {str(e)}")
+        replica_pool = None
+
 def get_logo_base64():
     try:
         logo_path = os.path.join(app.static_folder, 'images', 'LOGO.jpg')
@@ -70,34 +248,336 @@ def get_logo_base64():
         logger.error(f"Error loading logo: {str(e)}")
         return None
 
+# Rows fetched per round trip by server-side (named) cursors
+STREAM_BATCH_SIZE = int(os.getenv('STREAM_BATCH_SIZE', 2000))
+
+# Query instrumentation thresholds (per request)
+QUERY_COUNT_WARN = int(os.getenv('QUERY_COUNT_WARN', 50))
+QUERY_TIME_WARN_MS = float(os.getenv('QUERY_TIME_WARN_MS', 500))
+REPEATED_QUERY_WARN = int(os.getenv('REPEATED_QUERY_WARN', 10))
+POOL_CONNECTIONS_WARN = int(os.getenv('POOL_CONNECTIONS_WARN', 2))
+SERVER_TIMING = os.getenv('SERVER_TIMING', '').lower() in ('1', 'true', 'yes')
+
+def get_query_stats():
+    """Return the query stats of the current request, or None outside a request"""
+    if has_request_context():
+        return g.get('query_stats')
+    return None
+
+def record_query(query, duration, rowcount):
+    stats = get_query_stats()
+    if stats is None:
+        return
+    if isinstance(query, bytes):
+        query = query.decode('utf-8', 'replace')
+    stats['queries'] += 1
+    stats['rows'] += max(rowcount or 0, 0)
+    stats['db_time'] += duration
+    stats['statements'][' '.join(str(query).split())] += 1
+
+# Slow query log
+SLOW_QUERY_MS = float(os.getenv('SLOW_QUERY_MS', 200))
+SLOW_QUERY_LOG = os.getenv('SLOW_QUERY_LOG', 'slow_queries.jsonl')
+SLOW_QUERY_BUFFER = int(os.getenv('SLOW_QUERY_BUFFER', 200))
+SLOW_QUERY_EXPLAIN_RATE = float(os.getenv('SLOW_QUERY_EXPLAIN_RATE', 0.1))
+SLOW_QUERY_EXPLAIN_TIMEOUT_MS = int(os.getenv('SLOW_QUERY_EXPLAIN_TIMEOUT_MS', 5000))
+
+# EXPLAIN ANALYZE runs the statement again, so anything that writes, locks or
+# advances a sequence is never sampled (checked on the literal-free text)
+EXPLAIN_UNSAFE_RE = re.compile(
+    r'\b(?:INSERT|UPDATE|DELETE|MERGE|TRUNCATE|COPY|LOCK|FOR\s+(?:NO\s+KEY\s+)?(?:UPDATE|SHARE|KEY\s+SHARE)'
+    r'|pg_(?:try_)?advisory\w*|nextval|setval|pg_sleep|pg_notify|set_config)\b',
+    re.IGNORECASE
+)
+
+slow_queries = deque(maxlen=SLOW_QUERY_BUFFER)
+slow_query_queue = queue.Queue(maxsize=100)
+slow_query_worker = None
+
+def normalize_sql(query):
+    """Collapse whitespace and replace literals so similar statements group together"""
+    if isinstance(query, bytes):
+        query = query.decode('utf-8', 'replace')
+    query = re.sub(r"'(?:[^']|'')*'", '?', str(query))
+    query = re.sub(r'\b\d+(?:\.\d+)?\b', '?', query)
+    return ' '.join(query.split())
+
+def param_shape(vars):
+    if vars is None:
+        return None
+    if isinstance(vars, dict):
+        return {key: type(value).__name__ for key, value in vars.items()}
+    return [type(value).__name__ for value in vars]
+
+def record_slow_query(cur, query, vars, duration):
+    entry = {
+        'time': datetime.now().isoformat(timespec='seconds'),
+        'duration_ms': round(duration * 1000, 1),
+        'sql': normalize_sql(query),
+        'params': param_shape(vars),
+        'route': request.endpoint if has_request_context() else None,
+        'plan': None
+    }
+    # Show the prepared statement's text rather than its EXECUTE, and explain
+    # the original SQL: the statement only exists on the connection that prepared it
+    prepared = re.match(r'EXECUTE (ps_\w+)', entry['sql'])
+    if prepared and prepared.group(1) in prepared_sql_source:
+        entry['sql'] = prepared_sql_text[prepared.group(1)]
+        entry['prepared'] = prepared.group(1)
+        query, order = prepared_sql_source[prepared.group(1)]
+        vars = [vars[index] for index in order]
+        entry['params'] = param_shape(vars)
+    slow_queries.append(entry)
+
+    # EXPLAIN ANALYZE executes the statement, so only sample plain reads
+    explain_sql = None
+    if (entry['sql'].upper().startswith(('SELECT', 'WITH')) and not EXPLAIN_UNSAFE_RE.search(entry['sql'])
+            and random.random() < SLOW_QUERY_EXPLAIN_RATE):
+        try:
+            explain_sql = cur.mogrify(query, vars).decode('utf-8', 'replace')
+        except Exception:
+            explain_sql = None
+
+    start_slow_query_worker()
+    try:
+        slow_query_queue.put_nowait((entry, explain_sql))
+    except queue.Full:
+        logger.warning("Slow query queue full, dropping entry")
+
+def explain_query(conn, sql):
+    """EXPLAIN ANALYZE in a read-only transaction that is always rolled back"""
+    with conn.cursor() as cur:
+        try:
+            cur.execute('SET TRANSACTION READ ONLY')
+            cur.execute('SET LOCAL statement_timeout = %s', (SLOW_QUERY_EXPLAIN_TIMEOUT_MS,))
+            # Never queue behind the locks the original transaction may still hold
+            cur.execute('SET LOCAL lock_timeout = %s', (min(SLOW_QUERY_EXPLAIN_TIMEOUT_MS, 1000),))
+            cur.execute('EXPLAIN (ANALYZE, BUFFERS) ' + sql)
+            return '\n'.join(row[0] for row in cur.fetchall())
+        finally:
+            conn.rollback()
+
+def process_slow_queries():
+    """Capture plans and append entries to the JSON-lines log, off the request path"""
+    conn = None
+    while True:
+        entry, explain_sql = slow_query_queue.get()
+        if explain_sql:
+            try:
+                if conn is None or conn.closed:
+                    conn = psycopg2.connect(database_url, sslmode=DATABASE_SSLMODE)
+                entry['plan'] = explain_query(conn, explain_sql)
+            except Exception as e:
+                logger.warning(f"Could not capture plan for slow query: {str(e)}")
+                if conn is not None:
+                    conn.close()
+                conn = None
+        if SLOW_QUERY_LOG:
+            try:
+                with open(SLOW_QUERY_LOG, 'a') as log_file:
+                    log_file.write(json.dumps(entry) + '\n')
+            except OSError as e:
+                logger.warning(f"Could not write slow query log: {str(e)}")
+
+def start_slow_query_worker():
+    global slow_query_worker
+    if slow_query_worker is None:
+        slow_query_worker = threading.Thread(target=process_slow_queries, name='slow-query-log', daemon=True)
+        slow_query_worker.start()
+
+class InstrumentedCursorMixin:
+    """Times every statement and records it against the current request"""
+    def execute(self, query, vars=None):
+        start = time.perf_counter()
+        try:
+            return super().execute(query, vars)
+        finally:
+            duration = time.perf_counter() - start
+            record_query(query, duration, self.rowcount)
+            if duration * 1000 >= SLOW_QUERY_MS:
+                record_slow_query(self, query, vars, duration)
+
+    def executemany(self, query, vars_list):
+        start = time.perf_counter()
+        try:
+            return super().executemany(query, vars_list)
+        finally:
+            duration = time.perf_counter() - start
+            record_query(query, duration, self.rowcount)
+            if duration * 1000 >= SLOW_QUERY_MS:
+                record_slow_query(self, query, None, duration)
+
+class InstrumentedCursor(InstrumentedCursorMixin, extensions.cursor):
+    pass
+
+class InstrumentedDictCursor(InstrumentedCursorMixin, extras.DictCursor):
+    pass
+
+def checkout_connection(source=None):
+    if (source or db_pool) is None:
+        raise psycopg2.OperationalError("Database is not connected")
+    conn = (source or db_pool).getconn()
+    stats = get_query_stats()
+    if stats is not None:
+        stats['connections'] += 1
+        stats['max_connections'] = max(stats['max_connections'], stats['connections'])
+    return conn
+
+def return_connection(conn, source=None):
+    (source or db_pool).putconn(conn)
+    stats = get_query_stats()
+    if stats is not None:
+        stats['connections'] -= 1
+
 @contextmanager
 def get_db_connection():
-    conn = db_pool.getconn()
+    conn = checkout_connection()
     try:
         yield conn
     finally:
-        db_pool.putconn(conn)
+        return_connection(conn)
+
+# Read replica routing
+READ_YOUR_WRITES_SECONDS = float(os.getenv('READ_YOUR_WRITES_SECONDS', 10))
+
+def reads_use_replica():
+    """Reads go to the replica unless this session wrote recently or the page is version-tagged"""
+    if replica_pool is None:
+        return False
+    if has_request_context() and (session.get('primary_until', 0) > time.time() or g.get('primary_reads')):
+        return False
+    return True
+
+def pin_session_to_primary():
+    if replica_pool is not None and has_request_context():
+        session['primary_until'] = time.time() + READ_YOUR_WRITES_SECONDS
+
+def checkout_read_connection():
+    """Take a read-only replica connection, falling back to the primary if the replica is down"""
+    try:
+        conn = checkout_connection(replica_pool)
+    except (pool.PoolError, psycopg2.OperationalError) as e:
+        logger.warning(f"Replica unavailable, reading from primary: {str(e)}")
+        return checkout_connection(db_pool), db_pool
+    if not conn.readonly:
+        conn.readonly = True
+    return conn, replica_pool
 
 @contextmanager
-def get_db_cursor(dict_cursor=False, commit=False):
-    conn = db_pool.getconn()
+def get_db_cursor(dict_cursor=False, commit=False, name=None, primary=False):
+    """Yield a cursor from the pool; pass a name for a server-side cursor that streams rows.
+
+    Cursors that don't commit are read-only and go to the replica when one is
+    configured; pass primary=True for reads that must see the latest writes.
+    """
+    if not commit and not primary and reads_use_replica():
+        conn, source = checkout_read_connection()
+    else:
+        conn, source = checkout_connection(db_pool), db_pool
     try:
         if dict_cursor:
-            cur = conn.cursor(cursor_factory=extras.DictCursor)
+            cur = conn.cursor(name, cursor_factory=InstrumentedDictCursor)
         else:
-            cur = conn.cursor()
+            cur = conn.cursor(name, cursor_factory=InstrumentedCursor)
+        if name:
+            cur.itersize = STREAM_BATCH_SIZE
         
         try:
             yield cur
             if commit:
                 conn.commit()
+                pin_session_to_primary()
         except Exception as e:
             conn.rollback()
             raise
         finally:
             cur.close()
     finally:
-        db_pool.putconn(conn)
+        return_connection(conn, source)
+
+# Prepared statements
+# auto: prepare unless the host is a transaction-mode pooler (Neon's "-pooler" endpoints),
+# where consecutive transactions may land on different server sessions
+DB_PREPARE_MODE = os.getenv('DB_PREPARE_MODE', 'auto').lower()
+PLACEHOLDER_RE = re.compile(r'%%|%\((\w+)\)s|%s')
+prepared_sql_text = {}
+# Per statement name: the original SQL with positional placeholders, and which
+# EXECUTE value fills each one, so slow prepared statements can still be EXPLAINed
+prepared_sql_source = {}
+
+class PreparedStatementConnection(extensions.connection):
+    """Connection that remembers which statements it has PREPAREd"""
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prepared_statements = set()
+        if DB_PREPARE_MODE == 'auto':
+            self.prepare_enabled = '-pooler' not in (self.info.host or '')
+        else:
+            self.prepare_enabled = DB_PREPARE_MODE == 'session'
+
+def prepare_sql(sql, params):
+    """Rewrite psycopg2 placeholders to $n and return (sql, positional values)"""
+    values = []
+    positions = {}
+
+    def placeholder(match):
+        if match.group(0) == '%%':
+            return '%'
+        if match.group(1) is not None:
+            key = match.group(1)
+            if key not in positions:
+                values.append(params[key])
+                positions[key] = len(values)
+            return f'${positions[key]}'
+        values.append(params[len(values)])
+        return f'${len(values)}'
+
+    return PLACEHOLDER_RE.sub(placeholder, sql), values
+
+def positional_sql(sql):
+    """Rewrite named placeholders to %s; returns (sql, index into the $n values for each %s)"""
+    order = []
+    positions = {}
+
+    def placeholder(match):
+        if match.group(0) == '%%':
+            return '%%'
+        if match.group(1) is not None:
+            order.append(positions.setdefault(match.group(1), len(positions)))
+        else:
+            order.append(len(order))
+        return '%s'
+
+    return PLACEHOLDER_RE.sub(placeholder, sql), order
+
+def execute_prepared(cur, sql, params=()):
+    """Run a hot statement through a per-connection PREPAREd plan.
+
+    Falls back to a plain execute for named cursors and when preparing is
+    disabled. Prepared statements outlive a rollback, so the per-connection
+    set stays accurate for as long as the pooled connection lives.
+    """
+    if cur.name or not getattr(cur.connection, 'prepare_enabled', False):
+        return cur.execute(sql, params)
+    name, values = prepare_statement(cur, sql, params)
+    return cur.execute(execute_sql(name, values), values)
+
+def prepare_statement(cur, sql, params=()):
+    """PREPARE sql on the cursor's connection if needed; returns (name, values)"""
+    conn = cur.connection
+    text, values = prepare_sql(sql, params)
+    name = 'ps_' + hashlib.md5(text.encode()).hexdigest()[:16]
+    if name not in conn.prepared_statements:
+        cur.execute(f'PREPARE {name} AS {text}')
+        conn.prepared_statements.add(name)
+        prepared_sql_text[name] = normalize_sql(text)
+        prepared_sql_source[name] = positional_sql(sql)
+    return name, values
+
+def execute_sql(name, values):
+    if values:
+        return f"EXECUTE {name} ({', '.join(['%s'] * len(values))})"
+    return f'EXECUTE {name}'
 
 def init_db():
     """Initialize database tables"""
@@ -135,24 +615,18 @@ def init_db():
             )
         ''')
         
-        # Create payments table
-        cur.execute('''
-            CREATE TABLE IF NOT EXISTS payments (
-                id SERIAL PRIMARY KEY,
-                student_id INTEGER NOT NULL REFERENCES students(id) ON DELETE CASCADE,
-                term_id INTEGER NOT NULL REFERENCES terms(id) ON DELETE CASCADE,
-                amount_paid DECIMAL(10,2) NOT NULL,
-                payment_date DATE NOT NULL,
-                receipt_number TEXT UNIQUE,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
+        # Create payments table, partitioned by year of payment_date
+        cur.execute("SELECT to_regclass('payments') IS NULL")
+        if cur.fetchone()[0]:
+            cur.execute('CREATE SEQUENCE IF NOT EXISTS payments_id_seq')
+            create_partitioned_payments(cur, 'payments')
+            cur.execute('ALTER SEQUENCE payments_id_seq OWNED BY payments.id')
         
-        # Create payment_allocations table
+        # Create payment_allocations table. payment_id can't be a foreign key into the
+        # partitioned payments table; a delete trigger on payments cascades instead.
         cur.execute('''
             CREATE TABLE IF NOT EXISTS payment_allocations (
-                payment_id INTEGER NOT NULL REFERENCES payments(id) ON DELETE CASCADE,
+                payment_id INTEGER NOT NULL,
                 term_id INTEGER NOT NULL REFERENCES terms(id) ON DELETE CASCADE,
                 amount DECIMAL(10,2) NOT NULL,
                 PRIMARY KEY (payment_id, term_id)
@@ -201,10 +675,208 @@ def init_db():
             )
         ''')
         
-        # Create indexes
-        cur.execute('CREATE INDEX IF NOT EXISTS idx_payments_student_id ON payments(student_id)')
-        cur.execute('CREATE INDEX IF NOT EXISTS idx_payments_term_id ON payments(term_id)')
-        cur.execute('CREATE INDEX IF NOT EXISTS idx_payments_receipt_number ON payments(receipt_number)')
+        # Academic years: graduation status, archived terms and per-student charges
+        cur.execute("ALTER TABLE students ADD COLUMN IF NOT EXISTS status TEXT NOT NULL DEFAULT 'active'")
+        cur.execute('ALTER TABLE students ADD COLUMN IF NOT EXISTS graduated_year TEXT')
+        cur.execute('ALTER TABLE terms ADD COLUMN IF NOT EXISTS academic_year TEXT')
+        cur.execute('ALTER TABLE terms ADD COLUMN IF NOT EXISTS is_archived BOOLEAN NOT NULL DEFAULT FALSE')
+        cur.execute('ALTER TABLE terms ADD COLUMN IF NOT EXISTS is_opening_balance BOOLEAN NOT NULL DEFAULT FALSE')
+        cur.execute('ALTER TABLE terms ADD COLUMN IF NOT EXISTS due_date DATE')
+        
+        cur.execute('''
+            CREATE TABLE IF NOT EXISTS academic_years (
+                name TEXT PRIMARY KEY,
+                opening_term_id INTEGER REFERENCES terms(id) ON DELETE SET NULL,
+                opened_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                closed_at TIMESTAMP
+            )
+        ''')
+        
+        # Per-student amount for a term, overriding terms.amount (used for opening balances)
+        cur.execute('''
+            CREATE TABLE IF NOT EXISTS student_term_charges (
+                student_id INTEGER NOT NULL REFERENCES students(id) ON DELETE CASCADE,
+                term_id INTEGER NOT NULL REFERENCES terms(id) ON DELETE CASCADE,
+                amount DECIMAL(10,2) NOT NULL,
+                PRIMARY KEY (student_id, term_id)
+            )
+        ''')
+        
+        cur.execute('''
+            CREATE TABLE IF NOT EXISTS term_balances_archive (
+                academic_year TEXT NOT NULL,
+                student_id INTEGER NOT NULL,
+                term_id INTEGER NOT NULL,
+                balance DECIMAL(10,2) NOT NULL,
+                archived_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (academic_year, student_id, term_id)
+            )
+        ''')
+        
+        # Create dashboard rollup tables, sharded so concurrent payments don't queue on one row
+        cur.execute('''
+            CREATE TABLE IF NOT EXISTS collection_rollup (
+                form TEXT NOT NULL,
+                term_id INTEGER NOT NULL REFERENCES terms(id) ON DELETE CASCADE,
+                shard SMALLINT NOT NULL,
+                collected DECIMAL(12,2) NOT NULL DEFAULT 0,
+                payment_count INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (form, term_id, shard)
+            )
+        ''')
+        
+        cur.execute('''
+            CREATE TABLE IF NOT EXISTS daily_collection_rollup (
+                payment_date DATE NOT NULL,
+                shard SMALLINT NOT NULL,
+                collected DECIMAL(12,2) NOT NULL DEFAULT 0,
+                payment_count INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (payment_date, shard)
+            )
+        ''')
+        
+        # Append-only journal of every payment change. Edits are a reversal followed by a new
+        # payment event, so summing amount per student and term gives what was paid.
+        cur.execute('''
+            CREATE TABLE IF NOT EXISTS payment_events (
+                id BIGSERIAL PRIMARY KEY,
+                payment_id INTEGER NOT NULL,
+                event_type TEXT NOT NULL CHECK (event_type IN ('payment', 'reversal')),
+                student_id INTEGER NOT NULL,
+                term_id INTEGER NOT NULL,
+                amount DECIMAL(10,2) NOT NULL,
+                payment_date DATE NOT NULL,
+                receipt_number TEXT,
+                recorded_by TEXT,
+                recorded_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        cur.execute('''
+            CREATE OR REPLACE FUNCTION reject_journal_change() RETURNS trigger AS $$
+            BEGIN
+                RAISE EXCEPTION '% is append-only', TG_TABLE_NAME;
+            END;
+            $$ LANGUAGE plpgsql
+        ''')
+        cur.execute('DROP TRIGGER IF EXISTS payment_events_append_only ON payment_events')
+        cur.execute('''
+            CREATE TRIGGER payment_events_append_only
+            BEFORE UPDATE OR DELETE OR TRUNCATE ON payment_events
+            FOR EACH STATEMENT EXECUTE FUNCTION reject_journal_change()
+        ''')
+        cur.execute('CREATE INDEX IF NOT EXISTS idx_payment_events_student ON payment_events(student_id, id)')
+        cur.execute('CREATE INDEX IF NOT EXISTS idx_payment_events_payment ON payment_events(payment_id)')
+        cur.execute('CREATE INDEX IF NOT EXISTS idx_payment_events_recorded_at ON payment_events USING BRIN (recorded_at)')
+        
+        # Nightly balance snapshots; last_event_id is the journal position each one includes
+        cur.execute('''
+            CREATE TABLE IF NOT EXISTS balance_snapshot_runs (
+                id SERIAL PRIMARY KEY,
+                snapshot_date DATE NOT NULL UNIQUE,
+                taken_at TIMESTAMP NOT NULL,
+                last_event_id BIGINT NOT NULL
+            )
+        ''')
+        cur.execute('''
+            CREATE TABLE IF NOT EXISTS balance_snapshots (
+                run_id INTEGER NOT NULL REFERENCES balance_snapshot_runs(id) ON DELETE CASCADE,
+                student_id INTEGER NOT NULL,
+                term_id INTEGER NOT NULL,
+                balance DECIMAL(10,2) NOT NULL,
+                PRIMARY KEY (run_id, student_id, term_id)
+            )
+        ''')
+        cur.execute('CREATE INDEX IF NOT EXISTS idx_balance_snapshot_runs_taken_at ON balance_snapshot_runs(taken_at)')
+        
+        # Journal existing payments once, so replaying the journal matches the payments table
+        cur.execute('''
+            SELECT EXISTS (SELECT 1 FROM payments)
+               AND NOT EXISTS (SELECT 1 FROM payment_events)
+        ''')
+        if cur.fetchone()[0]:
+            for table in payment_ledger_tables(cur):
+                journal_payments(cur, 1, 'TRUE', (), recorded_by='backfill', table=table)
+        
+        # Backfill rollups the first time they are created on an existing database
+        cur.execute('''
+            SELECT EXISTS (SELECT 1 FROM payments)
+               AND NOT EXISTS (SELECT 1 FROM daily_collection_rollup)
+        ''')
+        if cur.fetchone()[0]:
+            rebuild_rollups(cur)
+        
+        # Data versions, bumped by triggers on every write to the versioned tables
+        cur.execute('''
+            CREATE TABLE IF NOT EXISTS data_versions (
+                name TEXT PRIMARY KEY,
+                version BIGINT NOT NULL DEFAULT 0
+            )
+        ''')
+        cur.execute('''
+            CREATE OR REPLACE FUNCTION bump_data_version() RETURNS trigger AS $$
+            BEGIN
+                -- One bump per transaction and version, however many rows it wrote
+                IF current_setting('fee_system.bumped_' || TG_ARGV[0], true)
+                        IS DISTINCT FROM txid_current()::text THEN
+                    UPDATE data_versions SET version = version + 1 WHERE name = TG_ARGV[0];
+                    PERFORM set_config('fee_system.bumped_' || TG_ARGV[0], txid_current()::text, true);
+                END IF;
+                RETURN NULL;
+            END;
+            $$ LANGUAGE plpgsql
+        ''')
+        ensure_data_version(cur, 'terms', 'terms')
+        ensure_data_version(cur, 'term_application_order', 'terms')
+        ensure_data_version(cur, 'students', 'students')
+        ensure_data_version(cur, 'student_balances', 'balances')
+        ensure_data_version(cur, 'outstanding_balance_notices', 'notices')
+        
+        # Create payments trigger, partitions and indexes
+        ensure_payment_objects(cur)
+        
+        # Create indexes for the remaining hot query shapes
+        cur.execute('''
+            CREATE INDEX IF NOT EXISTS idx_notices_unpaid_student
+            ON outstanding_balance_notices(student_id) WHERE NOT is_paid
+        ''')
+        cur.execute('CREATE INDEX IF NOT EXISTS idx_term_balances_term_id ON term_balances(term_id)')
+        cur.execute('CREATE INDEX IF NOT EXISTS idx_payment_allocations_term_id ON payment_allocations(term_id)')
+        cur.execute('''
+            CREATE INDEX IF NOT EXISTS idx_student_balances_owing
+            ON student_balances(current_balance) WHERE current_balance > 0
+        ''')
+        
+        # Soft deletes, and indexes for every foreign key the delete service walks
+        cur.execute('ALTER TABLE students ADD COLUMN IF NOT EXISTS deleted_at TIMESTAMP')
+        cur.execute('ALTER TABLE terms ADD COLUMN IF NOT EXISTS deleted_at TIMESTAMP')
+        cur.execute('CREATE INDEX IF NOT EXISTS idx_notices_student_id ON outstanding_balance_notices(student_id)')
+        cur.execute('CREATE INDEX IF NOT EXISTS idx_student_term_charges_term_id ON student_term_charges(term_id)')
+        cur.execute('CREATE INDEX IF NOT EXISTS idx_collection_rollup_term_id ON collection_rollup(term_id)')
+        
+        # One row per add_payment form, so retried submissions return the original payment
+        cur.execute('''
+            CREATE TABLE IF NOT EXISTS payment_submissions (
+                token TEXT PRIMARY KEY,
+                payment_id INTEGER,
+                receipt_number TEXT,
+                term_balance DECIMAL(10,2),
+                cumulative_balance DECIMAL(10,2),
+                created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        cur.execute('CREATE INDEX IF NOT EXISTS idx_payment_submissions_created_at ON payment_submissions USING BRIN (created_at)')
+        
+        # Notice escalation
+        cur.execute('ALTER TABLE outstanding_balance_notices ADD COLUMN IF NOT EXISTS escalated_at TIMESTAMP')
+        cur.execute('ALTER TABLE outstanding_balance_notices ADD COLUMN IF NOT EXISTS escalation_level INTEGER NOT NULL DEFAULT 0')
+        cur.execute('''
+            ALTER TABLE outstanding_balance_notices ADD COLUMN IF NOT EXISTS escalated_from INTEGER
+            REFERENCES outstanding_balance_notices(id) ON DELETE SET NULL
+        ''')
+        cur.execute('''
+            CREATE INDEX IF NOT EXISTS idx_notices_overdue
+            ON outstanding_balance_notices(due_date) WHERE NOT is_paid AND escalated_at IS NULL
+        ''')
         
         # Create admin user if not exists
         cur.execute("SELECT 1 FROM users WHERE username = 'admin'")
@@ -212,103 +884,1290 @@ def init_db():
             hashed_password = generate_password_hash('admin')
             cur.execute('INSERT INTO users (username, password) VALUES (%s, %s)', 
                        ('admin', hashed_password))
-def calculate_term_balance(student_id, term_id):
-    """Calculate and update balance for a specific term"""
-    with get_db_cursor(commit=True) as cur:  # Added commit=True to ensure updates are saved
-        try:
-            # Get term amount
-            cur.execute('SELECT amount FROM terms WHERE id = %s', (term_id,))
-            term_result = cur.fetchone()
-            term_amount = term_result[0] if term_result else Decimal('0')
-            
-            # Get total payments for this term
+def ensure_data_version(cur, table, name):
+    """Bump the <name> row of data_versions whenever a transaction writes to table.
+
+    The bump is an ordinary UPDATE, so it becomes visible at the same commit
+    as the rows it versions. The trigger is deferred so the row is only locked
+    for the moment the writer commits.
+    """
+    # Carry on from the sequence earlier versions used, so old ETags can't match again
+    cur.execute('SELECT to_regclass(%s) IS NOT NULL', (f'data_version_{name}',))
+    if cur.fetchone()[0]:
+        cur.execute(f'''
+            INSERT INTO data_versions (name, version)
+            SELECT %s, CASE WHEN is_called THEN last_value ELSE 0 END FROM data_version_{name}
+            ON CONFLICT (name) DO UPDATE SET version = GREATEST(data_versions.version, EXCLUDED.version)
+        ''', (name,))
+        cur.execute(f'DROP SEQUENCE data_version_{name}')
+    else:
+        cur.execute('INSERT INTO data_versions (name) VALUES (%s) ON CONFLICT (name) DO NOTHING', (name,))
+    cur.execute(f'DROP TRIGGER IF EXISTS {table}_data_version ON {table}')
+    cur.execute(f'''
+        CREATE CONSTRAINT TRIGGER {table}_data_version
+        AFTER INSERT OR UPDATE OR DELETE ON {table}
+        DEFERRABLE INITIALLY DEFERRED
+        FOR EACH ROW EXECUTE FUNCTION bump_data_version('{name}')
+    ''')
+
+# Data versions are read on the primary, and before (or in the same statement as)
+# the data they version: a copy can then be newer than its version, never older
+def read_data_version(cur, name):
+    return read_data_versions(cur, [name])[0]
+
+def read_data_versions(cur, names):
+    """Read several data versions in one round trip"""
+    cur.execute('SELECT name, version FROM data_versions WHERE name = ANY(%s)', (list(names),))
+    versions = dict(cur.fetchall())
+    return tuple(versions.get(name, 0) for name in names)
+
+# Payment partitions
+PAYMENT_PARTITION_RE = re.compile(r'payments_y(\d{4})')
+
+def create_partitioned_payments(cur, table):
+    """Create an empty payments-shaped table partitioned by payment_date, plus its default partition"""
+    cur.execute(f'''
+        CREATE TABLE {table} (
+            id INTEGER NOT NULL DEFAULT nextval('payments_id_seq'),
+            student_id INTEGER NOT NULL REFERENCES students(id) ON DELETE CASCADE,
+            term_id INTEGER NOT NULL REFERENCES terms(id) ON DELETE CASCADE,
+            amount_paid DECIMAL(10,2) NOT NULL,
+            payment_date DATE NOT NULL,
+            receipt_number TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (id, payment_date),
+            UNIQUE (receipt_number, payment_date)
+        ) PARTITION BY RANGE (payment_date)
+    ''')
+    cur.execute(f'CREATE TABLE {table}_default PARTITION OF {table} DEFAULT')
+
+def payments_partitioned(cur):
+    cur.execute("SELECT relkind = 'p' FROM pg_class WHERE oid = 'payments'::regclass")
+    return cur.fetchone()[0]
+
+def ensure_payment_partition(cur, year):
+    """Create the payments partition for a calendar year if it is missing.
+
+    Rows for that year already sitting in the default partition (a mistyped
+    future date) would make the CREATE fail, so the default partition is
+    detached, its rows for the year moved into the new partition, and re-attached.
+    """
+    cur.execute('SELECT to_regclass(%s) IS NULL', (f'payments_y{year}',))
+    if not cur.fetchone()[0]:
+        return
+    create_sql = f'''
+        CREATE TABLE payments_y{year} PARTITION OF payments
+        FOR VALUES FROM ('{year}-01-01') TO ('{year + 1}-01-01')
+    '''
+    in_year = f"payment_date >= '{year}-01-01' AND payment_date < '{year + 1}-01-01'"
+    cur.execute("SELECT to_regclass('payments_default') IS NOT NULL")
+    if cur.fetchone()[0]:
+        cur.execute(f'SELECT COUNT(*) FROM payments_default WHERE {in_year}')
+        stranded = cur.fetchone()[0]
+    else:
+        stranded = 0
+    if not stranded:
+        cur.execute(create_sql)
+        return
+
+    cur.execute('''
+        SELECT string_agg(quote_ident(attname), ', ' ORDER BY attnum)
+        FROM pg_attribute
+        WHERE attrelid = 'payments'::regclass AND attnum > 0 AND NOT attisdropped
+    ''')
+    columns = cur.fetchone()[0]
+    cur.execute('ALTER TABLE payments DETACH PARTITION payments_default')
+    cur.execute(create_sql)
+    cur.execute(f'''
+        WITH moved AS (DELETE FROM payments_default WHERE {in_year} RETURNING {columns})
+        INSERT INTO payments_y{year} ({columns}) SELECT {columns} FROM moved
+    ''')
+    cur.execute('ALTER TABLE payments ATTACH PARTITION payments_default DEFAULT')
+    logger.warning(f"Moved {stranded} payments dated {year} out of payments_default into payments_y{year}")
+
+def list_payment_partitions(cur, parent):
+    """Years of the yearly partitions attached to parent, oldest first"""
+    cur.execute('''
+        SELECT c.relname
+        FROM pg_inherits i
+        JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE i.inhparent = to_regclass(%s)
+    ''', (parent,))
+    years = [PAYMENT_PARTITION_RE.fullmatch(name) for (name,) in cur.fetchall()]
+    return sorted(int(match.group(1)) for match in years if match)
+
+def ensure_payment_objects(cur):
+    """Create the triggers, upcoming partitions and indexes that hang off payments"""
+    ensure_data_version(cur, 'payments', 'payments')
+    cur.execute('''
+        CREATE OR REPLACE FUNCTION delete_payment_allocations() RETURNS trigger AS $$
+        BEGIN
+            DELETE FROM payment_allocations WHERE payment_id = OLD.id;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql
+    ''')
+    cur.execute('DROP TRIGGER IF EXISTS payments_delete_allocations ON payments')
+    cur.execute('''
+        CREATE TRIGGER payments_delete_allocations
+        AFTER DELETE ON payments
+        FOR EACH ROW EXECUTE FUNCTION delete_payment_allocations()
+    ''')
+    if payments_partitioned(cur):
+        this_year = datetime.now().year
+        for year in (this_year, this_year + 1):
+            ensure_payment_partition(cur, year)
+    
+    # (student_id, term_id) covers per-student and per-term sums; student_id alone is redundant
+    cur.execute('''
+        CREATE INDEX IF NOT EXISTS idx_payments_student_term
+        ON payments(student_id, term_id) INCLUDE (amount_paid)
+    ''')
+    cur.execute('DROP INDEX IF EXISTS idx_payments_student_id')
+    cur.execute('CREATE INDEX IF NOT EXISTS idx_payments_term_id ON payments(term_id)')
+    cur.execute('CREATE INDEX IF NOT EXISTS idx_payments_receipt_number ON payments(receipt_number)')
+
+def partition_payments(cur):
+    """Convert a plain payments heap into the yearly-partitioned layout. Returns rows moved."""
+    cur.execute('LOCK TABLE payments IN ACCESS EXCLUSIVE MODE')
+    cur.execute('''
+        SELECT conname FROM pg_constraint
+        WHERE confrelid = 'payments'::regclass AND contype = 'f'
+    ''')
+    for (constraint,) in cur.fetchall():
+        cur.execute(f'ALTER TABLE payment_allocations DROP CONSTRAINT {constraint}')
+    cur.execute('ALTER TABLE payments RENAME TO payments_unpartitioned')
+    cur.execute('ALTER INDEX IF EXISTS payments_pkey RENAME TO payments_unpartitioned_pkey')
+    cur.execute('ALTER TABLE payments_unpartitioned ALTER COLUMN id DROP DEFAULT')
+    cur.execute('ALTER SEQUENCE payments_id_seq OWNED BY NONE')
+    create_partitioned_payments(cur, 'payments')
+    cur.execute('ALTER SEQUENCE payments_id_seq OWNED BY payments.id')
+
+    cur.execute('''
+        SELECT EXTRACT(YEAR FROM MIN(payment_date))::int, EXTRACT(YEAR FROM MAX(payment_date))::int
+        FROM payments_unpartitioned
+    ''')
+    first_year, last_year = cur.fetchone()
+    this_year = datetime.now().year
+    for year in range(min(first_year or this_year, this_year), max(last_year or this_year, this_year + 1) + 1):
+        ensure_payment_partition(cur, year)
+
+    cur.execute('''
+        INSERT INTO payments (id, student_id, term_id, amount_paid, payment_date,
+                              receipt_number, created_at, updated_at)
+        SELECT id, student_id, term_id, amount_paid, payment_date,
+               receipt_number, created_at, updated_at
+        FROM payments_unpartitioned
+    ''')
+    moved = cur.rowcount
+    cur.execute('DROP TABLE payments_unpartitioned')
+    ensure_payment_objects(cur)
+    return moved
+
+def archive_payment_partitions(cur, before_year):
+    """Move yearly partitions older than before_year from payments to payments_archive"""
+    cur.execute("SELECT to_regclass('payments_archive') IS NULL")
+    if cur.fetchone()[0]:
+        create_partitioned_payments(cur, 'payments_archive')
+    archived = []
+    for year in list_payment_partitions(cur, 'payments'):
+        if year >= before_year:
+            continue
+        cur.execute(f'''
+            SELECT EXISTS (
+                SELECT 1 FROM payments_y{year} p
+                JOIN terms t ON t.id = p.term_id
+                WHERE NOT t.is_archived
+            )
+        ''')
+        if cur.fetchone()[0]:
+            logger.warning(f"Not archiving payments_y{year}: it holds payments for open terms")
+            continue
+        cur.execute(f'ALTER TABLE payments DETACH PARTITION payments_y{year}')
+        cur.execute(f'''
+            ALTER TABLE payments_archive ATTACH PARTITION payments_y{year}
+            FOR VALUES FROM ('{year}-01-01') TO ('{year + 1}-01-01')
+        ''')
+        archived.append(year)
+    return archived
+
+# Term catalog cache
+TERM_CACHE_CHECK_SECONDS = float(os.getenv('TERM_CACHE_CHECK_SECONDS', 5))
+term_cache = {'version': None, 'checked': 0, 'terms': None}
+term_cache_lock = threading.Lock()
+
+def get_term_catalog():
+    """Return every term (id, name, amount, application_order, academic year flags) ordered by id.
+
+    The list is cached per worker and only re-read when the terms data version
+    changes; the version itself is checked at most every TERM_CACHE_CHECK_SECONDS.
+    """
+    with term_cache_lock:
+        if term_cache['terms'] is not None and time.monotonic() < term_cache['checked'] + TERM_CACHE_CHECK_SECONDS:
+            return term_cache['terms']
+        cached_version = term_cache['version']
+        cached_terms = term_cache['terms']
+
+    with get_db_cursor(dict_cursor=True, primary=True) as cur:
+        version = read_data_version(cur, 'terms')
+        if version == cached_version and cached_terms is not None:
+            terms = cached_terms
+        else:
+            # The version comes from the same snapshot as the rows it is cached under
             cur.execute('''
-                SELECT COALESCE(SUM(amount_paid), 0)
-                FROM payments
-                WHERE student_id = %s AND term_id = %s
-            ''', (student_id, term_id))
-            total_paid = cur.fetchone()[0] or Decimal('0')
-            
-            balance = term_amount - total_paid
-            
-            # Update term_balances table
+                SELECT v.version, t.id, t.name, t.amount, tao.application_order,
+                       t.academic_year, t.is_archived, t.is_opening_balance
+                FROM data_versions v
+                LEFT JOIN (terms t LEFT JOIN term_application_order tao ON tao.term_id = t.id)
+                    ON t.deleted_at IS NULL
+                WHERE v.name = 'terms'
+                ORDER BY t.id
+            ''')
+            rows = [dict(row) for row in cur.fetchall()]
+            version = rows[0].pop('version') if rows else 0
+            for row in rows[1:]:
+                del row['version']
+            terms = [row for row in rows if row['id'] is not None]
+
+    with term_cache_lock:
+        term_cache['version'] = version
+        term_cache['terms'] = terms
+        term_cache['checked'] = time.monotonic()
+    return terms
+
+def get_term(term_id):
+    term_id = int(term_id)
+    return next((term for term in get_term_catalog() if term['id'] == term_id), None)
+
+def invalidate_term_cache():
+    """Drop this worker's copy; other workers pick up the new version on their next check"""
+    with term_cache_lock:
+        term_cache['terms'] = None
+        term_cache['version'] = None
+
+# What each student owes for each open term. Regular terms charge active students the
+# term amount; student_term_charges overrides that (opening balances carried forward).
+STUDENT_CHARGES_SQL = '''
+    SELECT s.id AS student_id, t.id AS term_id,
+           CASE
+               WHEN s.deleted_at IS NOT NULL THEN 0
+               WHEN stc.amount IS NOT NULL THEN stc.amount
+               WHEN t.is_opening_balance OR s.status <> 'active' THEN 0
+               ELSE t.amount
+           END AS amount
+    FROM students s
+    CROSS JOIN terms t
+    LEFT JOIN student_term_charges stc ON stc.student_id = s.id AND stc.term_id = t.id
+    WHERE NOT t.is_archived AND t.deleted_at IS NULL
+'''
+
+# Balance writer locks, held until the transaction ends
+BALANCE_LOCK_NAMESPACE = 4101
+BALANCE_BULK_LOCK_ID = 4102
+# Writers touching more students than this lock everyone rather than taking a lock per student
+BALANCE_LOCK_MAX_STUDENTS = int(os.getenv('BALANCE_LOCK_MAX_STUDENTS', 50))
+
+def lock_student_balances(cur, student_ids=None):
+    """Serialize balance writers per student; other students stay parallel.
+
+    Per-student writers hold the bulk lock shared. Refreshes of every student
+    (student_ids None) or of many take it exclusively, so they wait for
+    in-flight payments and hold new ones back until they commit, instead of
+    upserting sums from an older snapshot over a payment's.
+    """
+    if student_ids is None or len(set(student_ids)) > BALANCE_LOCK_MAX_STUDENTS:
+        cur.execute('SELECT pg_advisory_xact_lock(%s)', (BALANCE_BULK_LOCK_ID,))
+        return
+    # One round trip; students in sorted order so two transactions locking the same pair can't deadlock
+    student_ids = sorted({int(student_id) for student_id in student_ids})
+    cur.execute('SELECT pg_advisory_xact_lock_shared(%s)' + ', pg_advisory_xact_lock(%s, %s)' * len(student_ids),
+                [BALANCE_BULK_LOCK_ID] + [value for student_id in student_ids
+                                          for value in (BALANCE_LOCK_NAMESPACE, student_id)])
+
+def refresh_term_balances(cur, student_ids=None, term_ids=None, from_journal=False):
+    """Recompute term_balances set-wise for the given students/terms (all when None).
+
+    from_journal sums payment_events instead of payments; both must agree.
+    """
+    lock_student_balances(cur, student_ids)
+    execute_prepared(cur, *term_balances_sql(student_ids, term_ids, from_journal))
+
+def term_balances_sql(student_ids=None, term_ids=None, from_journal=False):
+    """The per-term SUM and upsert behind refresh_term_balances, as (sql, params)"""
+    paid_table, paid_column = ('payment_events', 'amount') if from_journal else ('payments', 'amount_paid')
+    charge_filter = ''
+    paid_filter = ''
+    if student_ids is not None:
+        charge_filter += ' AND s.id = ANY(%(student_ids)s)'
+        paid_filter += ' AND student_id = ANY(%(student_ids)s)'
+    if term_ids is not None:
+        charge_filter += ' AND t.id = ANY(%(term_ids)s)'
+        paid_filter += ' AND term_id = ANY(%(term_ids)s)'
+    return f'''
+        WITH charges AS ({STUDENT_CHARGES_SQL}{charge_filter}),
+        paid AS (
+            SELECT student_id, term_id, SUM({paid_column}) AS paid
+            FROM {paid_table}
+            WHERE TRUE{paid_filter}
+            GROUP BY student_id, term_id
+        )
+        INSERT INTO term_balances (student_id, term_id, balance)
+        SELECT c.student_id, c.term_id, c.amount - COALESCE(p.paid, 0)
+        FROM charges c
+        LEFT JOIN paid p ON p.student_id = c.student_id AND p.term_id = c.term_id
+        ON CONFLICT (student_id, term_id) DO UPDATE
+        SET balance = EXCLUDED.balance
+    ''', {'student_ids': list(student_ids or []), 'term_ids': list(term_ids or [])}
+
+def refresh_student_balances(cur, student_ids=None):
+    """Set student_balances to the sum of open term balances (all students when None)"""
+    lock_student_balances(cur, student_ids)
+    student_filter = ' AND s.id = ANY(%(student_ids)s)' if student_ids is not None else ''
+    execute_prepared(cur, f'''
+        INSERT INTO student_balances (student_id, current_balance)
+        SELECT s.id, COALESCE(SUM(tb.balance), 0)
+        FROM students s
+        LEFT JOIN term_balances tb ON tb.student_id = s.id
+            AND tb.term_id IN (SELECT id FROM terms WHERE NOT is_archived AND deleted_at IS NULL)
+        WHERE TRUE{student_filter}
+        GROUP BY s.id
+        ON CONFLICT (student_id) DO UPDATE
+        SET current_balance = EXCLUDED.current_balance,
+            updated_at = CURRENT_TIMESTAMP
+    ''', {'student_ids': list(student_ids or [])})
+    settle_notices(cur, student_ids)
+
+def settle_notices(cur, student_ids=None):
+    """Mark unpaid notices paid for students whose balance is cleared; returns notices settled"""
+    student_filter = ' AND n.student_id = ANY(%(student_ids)s)' if student_ids is not None else ''
+    execute_prepared(cur, f'''
+        UPDATE outstanding_balance_notices n
+        SET is_paid = TRUE,
+            paid_date = COALESCE((SELECT MAX(p.payment_date) FROM payments p WHERE p.student_id = n.student_id),
+                                 CURRENT_DATE)
+        FROM student_balances sb
+        WHERE sb.student_id = n.student_id
+          AND NOT n.is_paid
+          AND sb.current_balance <= 0{student_filter}
+    ''', {'student_ids': list(student_ids or [])})
+    if cur.rowcount:
+        logger.info(f"Settled {cur.rowcount} outstanding balance notices")
+    return cur.rowcount
+
+def rebalance_students(cur, student_ids=None):
+    """Recompute term and cumulative balances for the given students (all when None)"""
+    refresh_term_balances(cur, student_ids)
+    refresh_student_balances(cur, student_ids)
+
+def calculate_term_balance(student_id, term_id, cur=None):
+    """Calculate and update balance for a specific term, in the caller's transaction when cur is given"""
+    if cur is None:
+        with get_db_cursor(commit=True) as own_cur:
+            return calculate_term_balance(student_id, term_id, own_cur)
+    try:
+        lock_student_balances(cur, [student_id])
+        refresh_term_balances(cur, [int(student_id)], [int(term_id)])
+        cur.execute('''
+            SELECT balance FROM term_balances
+            WHERE student_id = %s AND term_id = %s
+        ''', (student_id, term_id))
+        row = cur.fetchone()
+        balance = row[0] if row else Decimal('0')
+        
+        balance_logger.info("Updated term balance - Student: %s, Term: %s, Balance: %s",
+                            student_id, term_id, balance, extra={'student_id': student_id})
+        return balance
+        
+    except Exception as e:
+        balance_logger.error("Error calculating term balance for student %s, term %s: %s",
+                             student_id, term_id, e, extra={'student_id': student_id})
+        raise  # Re-raise the exception to be handled by the caller
+
+def calculate_cumulative_balance(student_id, cur=None):
+    """Calculate and update total outstanding balance across all open terms, in the caller's transaction when cur is given"""
+    if cur is None:
+        with get_db_cursor(commit=True) as own_cur:
+            return calculate_cumulative_balance(student_id, own_cur)
+    try:
+        lock_student_balances(cur, [student_id])
+        rebalance_students(cur, [int(student_id)])
+        cur.execute('SELECT current_balance FROM student_balances WHERE student_id = %s', (student_id,))
+        row = cur.fetchone()
+        total_balance = row[0] if row else Decimal('0')
+        
+        balance_logger.info("Updated cumulative balance for student %s: %s",
+                            student_id, total_balance, extra={'student_id': student_id})
+        return total_balance
+        
+    except Exception as e:
+        balance_logger.error("Error calculating cumulative balance for student %s: %s",
+                             student_id, e, extra={'student_id': student_id})
+        raise  # Re-raise the exception to be handled by the caller
+
+def calculate_student_balance(student_id, cur=None):
+    """Recalculate all term balances and the cumulative balance for a student"""
+    return calculate_cumulative_balance(student_id, cur)
+
+RECORDED_BALANCES_SQL = '''
+    SELECT
+        (SELECT balance FROM term_balances WHERE student_id = %(student_id)s AND term_id = %(term_id)s),
+        (SELECT current_balance FROM student_balances WHERE student_id = %(student_id)s)
+'''
+
+def record_payment(cur, student_id, term_id, amount_paid, payment_date, receipt_number=None):
+    """Insert a payment and bring the student's balances up to date in the caller's transaction.
+
+    Returns the payment id, receipt number and the student's new term and cumulative balances.
+    Pass receipt_number to keep one already printed (offline receipts).
+    """
+    lock_student_balances(cur, [student_id])
+    cur.execute("SELECT nextval('payments_id_seq')")
+    payment_id = cur.fetchone()[0]
+    receipt_number = receipt_number or generate_receipt_number(payment_id)
+    execute_prepared(cur, '''
+        INSERT INTO payments 
+        (id, student_id, term_id, amount_paid, payment_date, receipt_number)
+        VALUES (%s, %s, %s, %s, %s, %s)
+    ''', (payment_id, student_id, term_id, amount_paid, payment_date, receipt_number))
+    apply_payment_rollups(cur, 1, 'p.id = %s', (payment_id,))
+    journal_payments(cur, 1, 'p.id = %s', (payment_id,))
+    rebalance_students(cur, [int(student_id)])
+    execute_prepared(cur, RECORDED_BALANCES_SQL, {'student_id': student_id, 'term_id': term_id})
+    term_balance, cumulative_balance = cur.fetchone()
+    return {
+        'payment_id': payment_id,
+        'receipt_number': receipt_number,
+        'term_balance': term_balance or Decimal('0'),
+        'cumulative_balance': cumulative_balance or Decimal('0')
+    }
+
+# Dashboard rollups
+ROLLUP_SHARDS = 8
+
+def apply_payment_rollups(cur, sign, where, params):
+    """Add (sign=1) or remove (sign=-1) the payments matching `where` from the dashboard rollups.
+
+    Call with sign=-1 before a payment is changed or deleted and sign=1 after it
+    is inserted or changed, inside the same transaction as the write.
+    """
+    execute_prepared(cur, f'''
+        INSERT INTO collection_rollup (form, term_id, shard, collected, payment_count)
+        SELECT s.form, p.term_id, p.student_id %% {ROLLUP_SHARDS},
+               %s * SUM(p.amount_paid), %s * COUNT(*)
+        FROM payments p
+        JOIN students s ON p.student_id = s.id
+        WHERE {where}
+        GROUP BY 1, 2, 3
+        ON CONFLICT (form, term_id, shard) DO UPDATE
+        SET collected = collection_rollup.collected + EXCLUDED.collected,
+            payment_count = collection_rollup.payment_count + EXCLUDED.payment_count
+    ''', [sign, sign] + list(params))
+
+    execute_prepared(cur, f'''
+        INSERT INTO daily_collection_rollup (payment_date, shard, collected, payment_count)
+        SELECT p.payment_date, p.student_id %% {ROLLUP_SHARDS},
+               %s * SUM(p.amount_paid), %s * COUNT(*)
+        FROM payments p
+        JOIN students s ON p.student_id = s.id
+        WHERE {where}
+        GROUP BY 1, 2
+        ON CONFLICT (payment_date, shard) DO UPDATE
+        SET collected = daily_collection_rollup.collected + EXCLUDED.collected,
+            payment_count = daily_collection_rollup.payment_count + EXCLUDED.payment_count
+    ''', [sign, sign] + list(params))
+
+    invalidate_dashboard_cache()
+
+# Payment journal
+def payment_ledger_tables(cur):
+    """payments, plus payments_archive once cold years have been detached"""
+    cur.execute("SELECT to_regclass('payments_archive') IS NOT NULL")
+    return ['payments', 'payments_archive'] if cur.fetchone()[0] else ['payments']
+
+def journal_payments(cur, sign, where, params, recorded_by=None, table='payments'):
+    """Append a payment (sign=1) or reversal (sign=-1) event for each payment matching where"""
+    if recorded_by is None:
+        recorded_by = session.get('username') if has_request_context() else 'system'
+    execute_prepared(cur, f'''
+        INSERT INTO payment_events
+            (payment_id, event_type, student_id, term_id, amount, payment_date, receipt_number, recorded_by)
+        SELECT p.id, %s, p.student_id, p.term_id, %s * p.amount_paid, p.payment_date, p.receipt_number, %s
+        FROM {table} p
+        WHERE {where}
+        ORDER BY p.id
+    ''', ('payment' if sign > 0 else 'reversal', sign, recorded_by, *params))
+
+def rebuild_rollups(cur):
+    """Recompute the dashboard rollups from scratch"""
+    cur.execute('DELETE FROM collection_rollup')
+    cur.execute('DELETE FROM daily_collection_rollup')
+    apply_payment_rollups(cur, 1, 'TRUE', [])
+
+DASHBOARD_CACHE_TTL = int(os.getenv('DASHBOARD_CACHE_TTL', 30))
+dashboard_cache = {'expires': 0, 'data': None}
+dashboard_cache_lock = threading.Lock()
+
+def invalidate_dashboard_cache():
+    dashboard_cache['expires'] = 0
+
+def get_dashboard_data():
+    """Dashboard figures from the rollup tables, cached for DASHBOARD_CACHE_TTL seconds"""
+    with dashboard_cache_lock:
+        if dashboard_cache['data'] is not None and time.monotonic() < dashboard_cache['expires']:
+            return dashboard_cache['data']
+
+    today = datetime.now().date()
+    with get_db_cursor(dict_cursor=True) as cur:
+        cur.execute("SELECT COUNT(*) FROM students WHERE status = 'active'")
+        student_count = cur.fetchone()[0]
+
+        cur.execute(f'''
+            WITH charges AS ({STUDENT_CHARGES_SQL})
+            SELECT t.id, t.name, t.amount,
+                   (SELECT COALESCE(SUM(c.amount), 0) FROM charges c WHERE c.term_id = t.id) AS billed,
+                   (SELECT COALESCE(SUM(r.collected), 0) FROM collection_rollup r WHERE r.term_id = t.id) AS collected
+            FROM terms t
+            WHERE NOT t.is_archived AND t.deleted_at IS NULL
+            ORDER BY t.id
+        ''')
+        terms = [dict(row) for row in cur.fetchall()]
+
+        cur.execute(f'''
+            WITH charges AS ({STUDENT_CHARGES_SQL}),
+            billed AS (
+                SELECT s.form, COUNT(DISTINCT s.id) AS students, COALESCE(SUM(c.amount), 0) AS billed
+                FROM students s
+                LEFT JOIN charges c ON c.student_id = s.id
+                WHERE s.status = 'active'
+                GROUP BY s.form
+            ),
+            collected AS (
+                SELECT r.form, SUM(r.collected) AS collected
+                FROM collection_rollup r
+                JOIN terms t ON t.id = r.term_id
+                WHERE NOT t.is_archived AND t.deleted_at IS NULL
+                GROUP BY r.form
+            )
+            SELECT b.form, b.students, b.billed, COALESCE(c.collected, 0) AS collected
+            FROM billed b
+            LEFT JOIN collected c ON c.form = b.form
+            ORDER BY b.form
+        ''')
+        forms = [dict(row) for row in cur.fetchall()]
+
+        cur.execute('''
+            SELECT payment_date, SUM(collected) AS collected, SUM(payment_count) AS payment_count
+            FROM daily_collection_rollup
+            WHERE payment_date > %s
+            GROUP BY payment_date
+            ORDER BY payment_date
+        ''', (today - timedelta(days=60),))
+        daily = [dict(row) for row in cur.fetchall()]
+
+        cur.execute('''
+            SELECT COUNT(*) FROM student_balances sb
+            JOIN students s ON s.id = sb.student_id AND s.deleted_at IS NULL
+            WHERE sb.current_balance > 0
+        ''')
+        arrears_count = cur.fetchone()[0]
+
+        cur.execute('''
+            SELECT p.amount_paid, s.name AS student_name, t.name AS term_name
+            FROM payments p
+            JOIN students s ON p.student_id = s.id AND s.deleted_at IS NULL
+            JOIN terms t ON p.term_id = t.id
+            ORDER BY p.id DESC
+            LIMIT 10
+        ''')
+        recent_payments = cur.fetchall()
+
+        cur.execute('''
+            SELECT s.name, s.admission_no, sb.current_balance AS balance
+            FROM student_balances sb
+            JOIN students s ON s.id = sb.student_id AND s.deleted_at IS NULL
+            WHERE sb.current_balance > 0
+            ORDER BY sb.current_balance DESC
+            LIMIT 10
+        ''')
+        top_debtors = cur.fetchall()
+
+    for row in terms + forms:
+        row['rate'] = float(row['collected'] / row['billed'] * 100) if row['billed'] else 0.0
+    today_row = next((day for day in daily if day['payment_date'] == today), None)
+
+    data = {
+        'student_count': student_count,
+        'today_payments': today_row['payment_count'] if today_row else 0,
+        'today_revenue': today_row['collected'] if today_row else 0,
+        'arrears_count': arrears_count,
+        'terms': terms,
+        'forms': forms,
+        'daily': daily,
+        'recent_payments': recent_payments,
+        'top_debtors': top_debtors
+    }
+    with dashboard_cache_lock:
+        dashboard_cache['data'] = data
+        dashboard_cache['expires'] = time.monotonic() + DASHBOARD_CACHE_TTL
+    return data
+
+# Academic year rollover
+FORM_SEQUENCE = [f.strip() for f in os.getenv('FORM_SEQUENCE', 'Form 1,Form 2,Form 3,Form 4').split(',') if f.strip()]
+ROLLOVER_LOCK_ID = 3401
+
+def rollover_academic_year(closing_year, new_year):
+    """Close an academic year and open the next one in a single transaction.
+
+    Returns a summary dict, or None when closing_year was already rolled over.
+    """
+    with get_db_cursor(commit=True) as cur:
+        cur.execute('SELECT pg_advisory_xact_lock(%s)', (ROLLOVER_LOCK_ID,))
+        cur.execute('SELECT closed_at FROM academic_years WHERE name = %s', (closing_year,))
+        row = cur.fetchone()
+        if row and row[0] is not None:
+            return None
+
+        # Bring balances up to date before they are frozen
+        rebalance_students(cur)
+
+        cur.execute('''
+            INSERT INTO term_balances_archive (academic_year, student_id, term_id, balance)
+            SELECT %s, tb.student_id, tb.term_id, tb.balance
+            FROM term_balances tb
+            JOIN terms t ON t.id = tb.term_id
+            WHERE NOT t.is_archived
+            ON CONFLICT DO NOTHING
+        ''', (closing_year,))
+        archived_balances = cur.rowcount
+        cur.execute('''
+            DELETE FROM term_balances tb
+            USING terms t
+            WHERE t.id = tb.term_id AND NOT t.is_archived
+        ''')
+
+        cur.execute('''
+            UPDATE terms
+            SET is_archived = TRUE, academic_year = COALESCE(academic_year, %s),
+                updated_at = CURRENT_TIMESTAMP
+            WHERE NOT is_archived
+        ''', (closing_year,))
+        archived_terms = cur.rowcount
+
+        # Carry forward what each student still owes (or has overpaid) as an opening balance
+        cur.execute('''
+            INSERT INTO terms (name, amount, academic_year, is_opening_balance)
+            VALUES (%s, 0, %s, TRUE)
+            RETURNING id
+        ''', (f'Opening Balance {new_year}', new_year))
+        opening_term_id = cur.fetchone()[0]
+        cur.execute('''
+            INSERT INTO student_term_charges (student_id, term_id, amount)
+            SELECT student_id, %s, current_balance
+            FROM student_balances
+            WHERE current_balance <> 0
+        ''', (opening_term_id,))
+        carried_forward = cur.rowcount
+
+        graduated = promoted = 0
+        if FORM_SEQUENCE:
             cur.execute('''
-                INSERT INTO term_balances (student_id, term_id, balance)
-                VALUES (%s, %s, %s)
-                ON CONFLICT (student_id, term_id) DO UPDATE
-                SET balance = EXCLUDED.balance
-            ''', (student_id, term_id, balance))
-            
-            logger.info(f"Updated term balance - Student: {student_id}, Term: {term_id}, Balance: {balance}")
-            return balance
-            
-        except Exception as e:
-            logger.error(f"Error calculating term balance for student {student_id}, term {term_id}: {str(e)}")
-            raise  # Re-raise the exception to be handled by the caller
-def calculate_cumulative_balance(student_id):
-    """Calculate and update total outstanding balance across all terms"""
-    with get_db_cursor(commit=True) as cur:  # Added commit=True to ensure changes are saved
-        try:
-            # Get all terms with their amounts
-            cur.execute('SELECT id, amount FROM terms ORDER BY id')
-            terms = cur.fetchall()
-            
-            total_balance = Decimal('0')
-            
-            # Calculate balance for each term and update term_balances
-            for term_id, term_amount in terms:
-                # Get total payments for this term
-                cur.execute('''
-                    SELECT COALESCE(SUM(amount_paid), 0)
-                    FROM payments
-                    WHERE student_id = %s AND term_id = %s
-                ''', (student_id, term_id))
-                total_paid = cur.fetchone()[0] or Decimal('0')
-                
-                term_balance = term_amount - total_paid
-                total_balance += term_balance
-                
-                # Update term-specific balance
-                cur.execute('''
-                    INSERT INTO term_balances (student_id, term_id, balance)
-                    VALUES (%s, %s, %s)
-                    ON CONFLICT (student_id, term_id) DO UPDATE
-                    SET balance = EXCLUDED.balance
-                ''', (student_id, term_id, term_balance))
-            
-            # Update the student's overall balance
+                UPDATE students
+                SET status = 'graduated', graduated_year = %s, updated_at = CURRENT_TIMESTAMP
+                WHERE status = 'active' AND form = %s
+            ''', (closing_year, FORM_SEQUENCE[-1]))
+            graduated = cur.rowcount
             cur.execute('''
-                INSERT INTO student_balances (student_id, current_balance)
-                VALUES (%s, %s)
-                ON CONFLICT (student_id) DO UPDATE
-                SET current_balance = EXCLUDED.current_balance,
-                    updated_at = CURRENT_TIMESTAMP
-            ''', (student_id, total_balance))
-            
-            logger.info(f"Updated cumulative balance for student {student_id}: {total_balance}")
-            return total_balance
-            
-        except Exception as e:
-            logger.error(f"Error calculating cumulative balance for student {student_id}: {str(e)}")
-            raise  # Re-raise the exception to be handled by the caller
-def generate_receipt_number():
-    """Generate a unique receipt number"""
+                UPDATE students s
+                SET form = m.next_form, updated_at = CURRENT_TIMESTAMP
+                FROM unnest(%s::text[], %s::text[]) AS m(form, next_form)
+                WHERE s.status = 'active' AND s.form = m.form
+            ''', (FORM_SEQUENCE[:-1], FORM_SEQUENCE[1:]))
+            promoted = cur.rowcount
+
+        rebalance_students(cur)
+
+        cur.execute('''
+            INSERT INTO academic_years (name, closed_at)
+            VALUES (%s, CURRENT_TIMESTAMP)
+            ON CONFLICT (name) DO UPDATE SET closed_at = EXCLUDED.closed_at
+        ''', (closing_year,))
+        cur.execute('''
+            INSERT INTO academic_years (name, opening_term_id)
+            VALUES (%s, %s)
+            ON CONFLICT (name) DO UPDATE SET opening_term_id = EXCLUDED.opening_term_id,
+                                             opened_at = CURRENT_TIMESTAMP
+        ''', (new_year, opening_term_id))
+
+    invalidate_term_cache()
+    invalidate_dashboard_cache()
+    summary = {
+        'archived_terms': archived_terms,
+        'archived_balances': archived_balances,
+        'carried_forward': carried_forward,
+        'graduated': graduated,
+        'promoted': promoted,
+        'opening_term_id': opening_term_id
+    }
+    logger.info(f"Rolled over academic year {closing_year} -> {new_year}: {summary}")
+    return summary
+
+def rollover_preview():
+    """Counts shown before running a rollover"""
+    with get_db_cursor(dict_cursor=True, primary=True) as cur:
+        cur.execute('''
+            SELECT s.form, COUNT(*) AS students,
+                   COALESCE(SUM(sb.current_balance), 0) AS balance
+            FROM students s
+            LEFT JOIN student_balances sb ON sb.student_id = s.id
+            WHERE s.status = 'active'
+            GROUP BY s.form
+            ORDER BY s.form
+        ''')
+        forms = cur.fetchall()
+        cur.execute('SELECT name, opened_at, closed_at FROM academic_years ORDER BY opened_at DESC')
+        years = cur.fetchall()
+    return forms, years
+
+# Deletion service
+DELETE_BATCH_SIZE = int(os.getenv('DELETE_BATCH_SIZE', 5000))
+SOFT_DELETE = os.getenv('SOFT_DELETE', '').lower() in ('1', 'true', 'yes')
+
+def delete_in_batches(cur, table, where, params, key='ctid'):
+    """Delete rows matching where, DELETE_BATCH_SIZE at a time; returns rows deleted.
+
+    Partitioned tables must pass a unique key column, since ctid repeats across partitions.
+    """
+    deleted = 0
+    while True:
+        cur.execute(f'''
+            DELETE FROM {table}
+            WHERE {key} = ANY(ARRAY(SELECT {key} FROM {table} WHERE {where} LIMIT %s))
+        ''', (*params, DELETE_BATCH_SIZE))
+        deleted += cur.rowcount
+        if cur.rowcount < DELETE_BATCH_SIZE:
+            return deleted
+
+def delete_student_records(cur, student_id, adjust_rollups=True):
+    """Hard-delete a student and everything hanging off it through indexed paths"""
+    if adjust_rollups:
+        apply_payment_rollups(cur, -1, 'p.student_id = %s', (student_id,))
+    journal_payments(cur, -1, 'p.student_id = %s', (student_id,))
+    # The payments delete trigger removes each payment's allocations by primary key
+    delete_in_batches(cur, 'payments', 'student_id = %s', (student_id,), key='id')
+    for table in ('outstanding_balance_notices', 'term_balances', 'student_term_charges', 'student_balances'):
+        delete_in_batches(cur, table, 'student_id = %s', (student_id,))
+    cur.execute('DELETE FROM students WHERE id = %s', (student_id,))
+    return cur.rowcount
+
+def delete_term_records(cur, term_id, adjust_rollups=True):
+    """Hard-delete a term and its children, then rebalance the students who were charged for it"""
+    cur.execute('''
+        SELECT student_id FROM term_balances WHERE term_id = %(term_id)s
+        UNION
+        SELECT student_id FROM payments WHERE term_id = %(term_id)s
+    ''', {'term_id': term_id})
+    affected = [row[0] for row in cur.fetchall()]
+    if adjust_rollups:
+        apply_payment_rollups(cur, -1, 'p.term_id = %s', (term_id,))
+    journal_payments(cur, -1, 'p.term_id = %s', (term_id,))
+    delete_in_batches(cur, 'payment_allocations', 'term_id = %s', (term_id,))
+    delete_in_batches(cur, 'payments', 'term_id = %s', (term_id,), key='id')
+    for table in ('term_balances', 'student_term_charges', 'collection_rollup'):
+        delete_in_batches(cur, table, 'term_id = %s', (term_id,))
+    cur.execute('DELETE FROM term_application_order WHERE term_id = %s', (term_id,))
+    cur.execute('DELETE FROM terms WHERE id = %s', (term_id,))
+    deleted = cur.rowcount
+    # Other terms' balances are untouched; only each student's total changes
+    refresh_student_balances(cur, affected)
+    return deleted
+
+def soft_delete_student(cur, student_id):
+    """Hide a student without touching child rows; purge_deleted removes them later"""
+    cur.execute('''
+        UPDATE students SET status = 'deleted', deleted_at = CURRENT_TIMESTAMP
+        WHERE id = %s AND deleted_at IS NULL
+    ''', (student_id,))
+    if cur.rowcount:
+        apply_payment_rollups(cur, -1, 'p.student_id = %s', (student_id,))
+        rebalance_students(cur, [student_id])
+    return cur.rowcount
+
+def soft_delete_term(cur, term_id):
+    """Hide a term and drop its balances; payments stay until purge_deleted"""
+    cur.execute('UPDATE terms SET deleted_at = CURRENT_TIMESTAMP WHERE id = %s AND deleted_at IS NULL', (term_id,))
+    if not cur.rowcount:
+        return 0
+    cur.execute('SELECT student_id FROM term_balances WHERE term_id = %s', (term_id,))
+    affected = [row[0] for row in cur.fetchall()]
+    delete_in_batches(cur, 'term_balances', 'term_id = %s', (term_id,))
+    refresh_student_balances(cur, affected)
+    return 1
+
+def purge_deleted():
+    """Hard-delete soft-deleted students and terms, one transaction per row"""
+    purged = {'students': 0, 'terms': 0}
+    with get_db_cursor(primary=True) as cur:
+        cur.execute('SELECT id FROM students WHERE deleted_at IS NOT NULL ORDER BY id')
+        student_ids = [row[0] for row in cur.fetchall()]
+        cur.execute('SELECT id FROM terms WHERE deleted_at IS NOT NULL ORDER BY id')
+        term_ids = [row[0] for row in cur.fetchall()]
+    for student_id in student_ids:
+        with get_db_cursor(commit=True) as cur:
+            purged['students'] += delete_student_records(cur, student_id, adjust_rollups=False)
+    for term_id in term_ids:
+        with get_db_cursor(commit=True) as cur:
+            # Soft-deleted terms are already hidden from the dashboard, so their rollups go with them
+            purged['terms'] += delete_term_records(cur, term_id)
+    if term_ids:
+        invalidate_term_cache()
+    invalidate_dashboard_cache()
+    return purged
+
+# Payment submission tokens
+SUBMISSION_TOKEN_RE = re.compile(r'[0-9a-f]{32}')
+SUBMISSION_TOKEN_DAYS = int(os.getenv('SUBMISSION_TOKEN_DAYS', 7))
+
+def find_submission(cur, token):
+    cur.execute('''
+        SELECT payment_id, receipt_number, term_balance, cumulative_balance
+        FROM payment_submissions
+        WHERE token = %s
+    ''', (token,))
+    row = cur.fetchone()
+    if not row:
+        return None
+    return dict(zip(('payment_id', 'receipt_number', 'term_balance', 'cumulative_balance'), row))
+
+def claim_submission(cur, token):
+    """Reserve token for this transaction; False when another submission already used it.
+
+    A concurrent retry blocks on the primary key until the first transaction
+    commits (and then gets False) or rolls back (and then gets the token).
+    """
+    cur.execute('INSERT INTO payment_submissions (token) VALUES (%s) ON CONFLICT (token) DO NOTHING', (token,))
+    return cur.rowcount == 1
+
+def save_submission(cur, token, payment):
+    cur.execute('''
+        UPDATE payment_submissions
+        SET payment_id = %s, receipt_number = %s, term_balance = %s, cumulative_balance = %s
+        WHERE token = %s
+    ''', (payment['payment_id'], payment['receipt_number'], payment['term_balance'],
+          payment['cumulative_balance'], token))
+
+def generate_receipt_number(payment_id=None):
+    """Generate a unique receipt number; the payment id suffix keeps same-second receipts apart"""
     timestamp = datetime.now().strftime("%Y%m%d%H%M%S")
-    return f"RCPT-{timestamp}"
+    return f"RCPT-{timestamp}-{payment_id}" if payment_id else f"RCPT-{timestamp}"
+
+# Offline cashier
+OFFLINE_DB_PATH = os.getenv('OFFLINE_DB_PATH', 'database.db')
+# Printed in provisional receipt numbers so desks never collide; required in offline mode
+OFFLINE_DEVICE_ID = re.sub(r'[^A-Za-z0-9]', '', os.getenv('OFFLINE_DEVICE_ID', ''))[:12]
+OFFLINE_SYNC_BATCH = int(os.getenv('OFFLINE_SYNC_BATCH', 200))
+# Background sync interval per worker; 0 leaves syncing to `flask sync-offline` and the status page
+OFFLINE_SYNC_SECONDS = int(os.getenv('OFFLINE_SYNC_SECONDS', 60))
+offline_sync_thread = None
+
+@contextmanager
+def get_local_cursor(dict_cursor=False, commit=False):
+    """get_db_cursor for the local SQLite database (placeholders are ?)"""
+    conn = sqlite3.connect(OFFLINE_DB_PATH, timeout=10)
+    conn.execute('PRAGMA synchronous=NORMAL')
+    if dict_cursor:
+        conn.row_factory = sqlite3.Row
+    try:
+        cur = conn.cursor()
+        try:
+            yield cur
+            if commit:
+                conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            cur.close()
+    finally:
+        conn.close()
+
+def init_offline_db():
+    """Bring the local database up to the offline cashier schema"""
+    with get_local_cursor(commit=True) as cur:
+        # WAL keeps the desk's writes from waiting on the sync's reads
+        cur.execute('PRAGMA journal_mode=WAL')
+        cur.execute('''
+            CREATE TABLE IF NOT EXISTS students (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                admission_no TEXT UNIQUE NOT NULL,
+                name TEXT NOT NULL,
+                form TEXT NOT NULL
+            )
+        ''')
+        cur.execute('''
+            CREATE TABLE IF NOT EXISTS terms (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                name TEXT UNIQUE NOT NULL,
+                amount REAL NOT NULL
+            )
+        ''')
+        cur.execute('''
+            CREATE TABLE IF NOT EXISTS payments (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                student_id INTEGER NOT NULL,
+                term_id INTEGER NOT NULL,
+                amount_paid REAL NOT NULL,
+                payment_date TEXT NOT NULL,
+                FOREIGN KEY(student_id) REFERENCES students(id),
+                FOREIGN KEY(term_id) REFERENCES terms(id)
+            )
+        ''')
+        columns = {
+            'students': [('current_balance', 'REAL NOT NULL DEFAULT 0')],
+            'payments': [('receipt_number', 'TEXT'), ('submission_token', 'TEXT'), ('recorded_by', 'TEXT'),
+                         ('recorded_at', 'TEXT'), ('synced_at', 'TEXT'), ('remote_payment_id', 'INTEGER'),
+                         ('sync_error', 'TEXT')]
+        }
+        for table, wanted in columns.items():
+            cur.execute(f'PRAGMA table_info({table})')
+            existing = {row[1] for row in cur.fetchall()}
+            for column, definition in wanted:
+                if column not in existing:
+                    cur.execute(f'ALTER TABLE {table} ADD COLUMN {column} {definition}')
+        cur.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_payments_submission_token ON payments(submission_token)')
+        cur.execute('CREATE INDEX IF NOT EXISTS idx_payments_pending ON payments(id) WHERE synced_at IS NULL')
+
+def local_money(value):
+    return Decimal(str(value)).quantize(Decimal('0.01'))
+
+def record_offline_payment(student_id, term_id, amount_paid, payment_date, token, recorded_by=None):
+    """Queue a payment locally; returns its local id (the original one when token was already used)"""
+    with get_local_cursor(commit=True) as cur:
+        cur.execute('SELECT id FROM payments WHERE submission_token = ?', (token,))
+        existing = cur.fetchone()
+        if existing:
+            return existing[0]
+        cur.execute('''
+            INSERT INTO payments (student_id, term_id, amount_paid, payment_date, submission_token,
+                                  recorded_by, recorded_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        ''', (student_id, term_id, float(amount_paid), payment_date.isoformat(), token, recorded_by,
+              datetime.now().isoformat(timespec='seconds')))
+        local_id = cur.lastrowid
+        cur.execute('UPDATE payments SET receipt_number = ? WHERE id = ?',
+                    (f'OFF-{OFFLINE_DEVICE_ID}-{local_id:06d}', local_id))
+        return local_id
+
+def push_offline_payments(batch_size=OFFLINE_SYNC_BATCH):
+    """Send one batch of queued payments to Postgres; returns Counter of synced/duplicate/conflict.
+
+    Every payment carries its form's submission token, so a batch that is
+    retried after a crash (or pushed by two workers at once) is recorded once.
+    """
+    with get_local_cursor(dict_cursor=True) as cur:
+        cur.execute('''
+            SELECT id, student_id, term_id, amount_paid, payment_date, receipt_number, submission_token
+            FROM payments
+            WHERE synced_at IS NULL AND sync_error IS NULL
+            ORDER BY id
+            LIMIT ?
+        ''', (batch_size,))
+        queued = [dict(row) for row in cur.fetchall()]
+    if not queued:
+        return Counter()
+
+    results = {}
+    with get_db_cursor(commit=True) as cur:
+        ledger_tables = payment_ledger_tables(cur)
+        cur.execute('SELECT id FROM students WHERE id = ANY(%s) AND deleted_at IS NULL',
+                    (list({row['student_id'] for row in queued}),))
+        live_students = {row[0] for row in cur.fetchall()}
+        # Student order keeps the per-student balance locks in a consistent order
+        for row in sorted(queued, key=lambda row: (row['student_id'], row['id'])):
+            term = get_term(row['term_id'])
+            if row['student_id'] not in live_students:
+                results[row['id']] = ('conflict', 'Student no longer exists')
+                continue
+            if term is None or term['is_archived']:
+                results[row['id']] = ('conflict', 'Term is closed or deleted')
+                continue
+            cur.execute('SAVEPOINT offline_payment')
+            try:
+                if not claim_submission(cur, row['submission_token']):
+                    original = find_submission(cur, row['submission_token'])
+                    results[row['id']] = ('duplicate', original['payment_id'] if original else None)
+                else:
+                    used_by = find_receipt_payment(cur, ledger_tables, row['receipt_number'])
+                    if used_by:
+                        # Another desk on the same ID, or this one after its database was reset
+                        cur.execute('ROLLBACK TO SAVEPOINT offline_payment')
+                        results[row['id']] = ('conflict', f"Receipt number already used by payment {used_by}")
+                    else:
+                        payment = record_payment(cur, row['student_id'], row['term_id'],
+                                                 local_money(row['amount_paid']),
+                                                 datetime.strptime(row['payment_date'], '%Y-%m-%d').date(),
+                                                 receipt_number=row['receipt_number'])
+                        save_submission(cur, row['submission_token'], payment)
+                        results[row['id']] = ('synced', payment['payment_id'])
+                cur.execute('RELEASE SAVEPOINT offline_payment')
+            except psycopg2.Error as e:
+                cur.execute('ROLLBACK TO SAVEPOINT offline_payment')
+                results[row['id']] = ('conflict', str(e).strip().splitlines()[0])
+
+    # Postgres has committed; a crash before this update is safe because the tokens are claimed
+    synced_at = datetime.now().isoformat(timespec='seconds')
+    with get_local_cursor(commit=True) as cur:
+        cur.executemany('UPDATE payments SET synced_at = ?, remote_payment_id = ? WHERE id = ?',
+                        [(synced_at, value, local_id) for local_id, (status, value) in results.items()
+                         if status != 'conflict'])
+        cur.executemany('UPDATE payments SET sync_error = ? WHERE id = ?',
+                        [(value, local_id) for local_id, (status, value) in results.items() if status == 'conflict'])
+    for local_id, (status, value) in results.items():
+        if status == 'conflict':
+            logger.warning(f"Offline payment {local_id} not synced: {value}")
+    return Counter(status for status, value in results.values())
+
+def find_receipt_payment(cur, tables, receipt_number):
+    """Id of a payment in any of tables already carrying receipt_number, or None"""
+    for table in tables:
+        cur.execute(f'SELECT id FROM {table} WHERE receipt_number = %s LIMIT 1', (receipt_number,))
+        row = cur.fetchone()
+        if row:
+            return row[0]
+    return None
+
+def refresh_offline_mirror():
+    """Copy students, balances and open terms into the local database for the offline desk"""
+    with get_db_cursor(primary=True) as cur:
+        cur.execute('''
+            SELECT s.id, s.admission_no, s.name, COALESCE(s.form, ''), COALESCE(sb.current_balance, 0)
+            FROM students s
+            LEFT JOIN student_balances sb ON sb.student_id = s.id
+            WHERE s.deleted_at IS NULL
+        ''')
+        students = [row[:4] + (float(row[4]),) for row in cur.fetchall()]
+    terms = [(term['id'], term['name'], float(term['amount'])) for term in get_term_catalog() if not term['is_archived']]
+    with get_local_cursor(commit=True) as cur:
+        cur.execute('DELETE FROM students')
+        cur.executemany('INSERT INTO students (id, admission_no, name, form, current_balance) VALUES (?, ?, ?, ?, ?)',
+                        students)
+        cur.execute('DELETE FROM terms')
+        cur.executemany('INSERT INTO terms (id, name, amount) VALUES (?, ?, ?)', terms)
+    return len(students), len(terms)
+
+def sync_offline():
+    """Push every queued payment in batches, then refresh the local mirror; returns the push totals"""
+    if db_pool is None:
+        init_db_pool()
+    totals = Counter()
+    while True:
+        batch = push_offline_payments()
+        totals.update(batch)
+        # Every pushed payment leaves the queue (synced or flagged), so a short batch means it is empty
+        if sum(batch.values()) < OFFLINE_SYNC_BATCH:
+            break
+    refresh_offline_mirror()
+    if totals:
+        logger.info(f"Offline sync: {dict(totals)}")
+    return totals
+
+def run_offline_sync():
+    while True:
+        time.sleep(OFFLINE_SYNC_SECONDS)
+        try:
+            sync_offline()
+        except (psycopg2.OperationalError, pool.PoolError) as e:
+            logger.info(f"Offline sync waiting for the database: {str(e).strip()}")
+        except Exception as e:
+            logger.error(f"Offline sync failed: {str(e)}", exc_info=True)
+
+def start_offline_sync():
+    global offline_sync_thread
+    if offline_sync_thread is None and OFFLINE_SYNC_SECONDS > 0:
+        offline_sync_thread = threading.Thread(target=run_offline_sync, name='offline-sync', daemon=True)
+        offline_sync_thread.start()
 
 # Initialize the connection pool
+if OFFLINE_CASHIER and not OFFLINE_DEVICE_ID:
+    raise ValueError("OFFLINE_CASHIER needs OFFLINE_DEVICE_ID, unique to this desk "
+                     "(pick a new one if its local database is ever reset)")
 init_db_pool()
+if OFFLINE_CASHIER:
+    init_offline_db()
+    start_offline_sync()
 
 # Helper functions
 def get_students():
     with get_db_cursor(dict_cursor=True) as cur:
-        cur.execute("SELECT id, name, admission_no FROM students ORDER BY name")
+        cur.execute("SELECT id, name, admission_no FROM students WHERE deleted_at IS NULL ORDER BY name")
         return cur.fetchall()
 
-def get_terms():
-    with get_db_cursor(dict_cursor=True) as cur:
-        cur.execute("SELECT id, name, amount FROM terms ORDER BY name")
-        return cur.fetchall()
+def get_terms(include_archived=False):
+    terms = [term for term in get_term_catalog() if include_archived or not term['is_archived']]
+    return sorted(terms, key=lambda term: term['name'])
+
+# Template caching
+# Compiled templates persist across worker restarts; empty disables the bytecode cache
+JINJA_CACHE_DIR = os.getenv('JINJA_CACHE_DIR', 'jinja_cache')
+# Rendered table rows kept per worker by {% cache %}
+FRAGMENT_CACHE_ENTRIES = int(os.getenv('FRAGMENT_CACHE_ENTRIES', 20000))
+fragment_cache = OrderedDict()
+fragment_cache_lock = threading.Lock()
+
+class FragmentCacheExtension(Extension):
+    """{% cache key %}...{% endcache %}: render the body once per key.
+
+    Keys should include the row id and whatever the body shows that can change
+    without the id changing (updated_at, joined names, balances).
+    """
+    tags = {'cache'}
+
+    def parse(self, parser):
+        lineno = next(parser.stream).lineno
+        key = parser.parse_expression()
+        body = parser.parse_statements(['name:endcache'], drop_needle=True)
+        return nodes.CallBlock(self.call_method('_cached_fragment', [key]), [], [], body).set_lineno(lineno)
+
+    def _cached_fragment(self, key, caller):
+        if not FRAGMENT_CACHE_ENTRIES:
+            return caller()
+        with fragment_cache_lock:
+            html = fragment_cache.get(key)
+            if html is not None:
+                fragment_cache.move_to_end(key)
+                return html
+        html = caller()
+        with fragment_cache_lock:
+            fragment_cache[key] = html
+            while len(fragment_cache) > FRAGMENT_CACHE_ENTRIES:
+                fragment_cache.popitem(last=False)
+        return html
+
+if JINJA_CACHE_DIR:
+    os.makedirs(JINJA_CACHE_DIR, exist_ok=True)
+    app.jinja_env.bytecode_cache = FileSystemBytecodeCache(JINJA_CACHE_DIR)
+app.jinja_env.add_extension(FragmentCacheExtension)
+
+# Request instrumentation
+@app.before_request
+def start_query_stats():
+    g.request_started = time.perf_counter()
+    g.query_stats = {
+        'queries': 0,
+        'rows': 0,
+        'db_time': 0.0,
+        'connections': 0,
+        'max_connections': 0,
+        'statements': Counter()
+    }
+
+@app.after_request
+def report_query_stats(response):
+    stats = g.get('query_stats')
+    if stats is None:
+        return response
+
+    total_ms = (time.perf_counter() - g.request_started) * 1000
+    db_ms = stats['db_time'] * 1000
+    route = request.endpoint or request.path
+
+    if stats['queries'] > QUERY_COUNT_WARN:
+        logger.warning(f"{route}: {stats['queries']} queries in one request (threshold {QUERY_COUNT_WARN})")
+    if db_ms > QUERY_TIME_WARN_MS:
+        logger.warning(f"{route}: {db_ms:.1f}ms spent in the database (threshold {QUERY_TIME_WARN_MS:.0f}ms)")
+    if stats['max_connections'] > POOL_CONNECTIONS_WARN:
+        logger.warning(f"{route}: held {stats['max_connections']} pooled connections at once")
+    for statement, count in stats['statements'].most_common():
+        if count < REPEATED_QUERY_WARN:
+            break
+        logger.warning(f"{route}: possible N+1, statement ran {count} times: {statement[:120]}")
+
+    if SERVER_TIMING:
+        response.headers.add('Server-Timing',
+                             f'db;dur={db_ms:.1f};desc="{stats["queries"]} queries, {stats["rows"]} rows"')
+        response.headers.add('Server-Timing', f'pool;desc="{stats["max_connections"]} connections"')
+        response.headers.add('Server-Timing', f'total;dur={total_ms:.1f}')
+    return response
+
+# Request profiling
+PROFILE_REQUESTS = os.getenv('PROFILE_REQUESTS', '').lower() in ('1', 'true', 'yes')
+PROFILE_SAMPLE_RATE = int(os.getenv('PROFILE_SAMPLE_RATE', 0))
+PROFILE_DIR = os.getenv('PROFILE_DIR', 'profiles')
+PROFILE_KEEP = int(os.getenv('PROFILE_KEEP', 200))
+
+def should_profile():
+    if request.endpoint in (None, 'static'):
+        return False
+    if PROFILE_REQUESTS:
+        return True
+    if request.headers.get('X-Profile') == '1' and session.get('username') in ADMIN_USERS:
+        return True
+    return PROFILE_SAMPLE_RATE > 0 and random.randrange(PROFILE_SAMPLE_RATE) == 0
+
+@app.before_request
+def start_profiler():
+    if should_profile():
+        g.profiler = cProfile.Profile()
+        g.profiler.enable()
+
+@app.after_request
+def save_profile(response):
+    profiler = g.pop('profiler', None)
+    if profiler is None:
+        return response
+    profiler.disable()
+
+    try:
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        name = f"{datetime.now().strftime('%Y%m%d-%H%M%S')}-{request.endpoint}-{uuid.uuid4().hex[:6]}"
+        base = os.path.join(PROFILE_DIR, name)
+        profiler.dump_stats(base + '.prof')
+
+        with open(base + '.txt', 'w') as report:
+            stats = pstats.Stats(profiler, stream=report)
+            stats.sort_stats('cumulative').print_stats(60)
+            stats.print_callees(30)
+
+        query_stats = g.get('query_stats') or {}
+        metadata = {
+            'name': name,
+            'route': request.endpoint,
+            'path': request.full_path,
+            'method': request.method,
+            'status': response.status_code,
+            'duration_ms': round((time.perf_counter() - g.request_started) * 1000, 1),
+            'queries': query_stats.get('queries'),
+            'db_ms': round(query_stats.get('db_time', 0) * 1000, 1),
+            'time': datetime.now().isoformat(timespec='seconds')
+        }
+        with open(base + '.json', 'w') as meta_file:
+            json.dump(metadata, meta_file)
+
+        prune_profiles()
+    except OSError as e:
+        logger.warning(f"Could not save request profile: {str(e)}")
+    return response
+
+def list_profiles():
+    if not os.path.isdir(PROFILE_DIR):
+        return []
+    profiles = []
+    for filename in sorted(os.listdir(PROFILE_DIR), reverse=True):
+        if filename.endswith('.json'):
+            try:
+                with open(os.path.join(PROFILE_DIR, filename)) as meta_file:
+                    profiles.append(json.load(meta_file))
+            except (OSError, ValueError):
+                continue
+    return profiles
+
+def prune_profiles():
+    for old in list_profiles()[PROFILE_KEEP:]:
+        for ext in ('.json', '.prof', '.txt'):
+            try:
+                os.remove(os.path.join(PROFILE_DIR, old['name'] + ext))
+            except OSError:
+                pass
 
 # Authentication
 def login_required(f):
@@ -320,6 +2179,74 @@ def login_required(f):
         return f(*args, **kwargs)
     return decorated_function
 
+ADMIN_USERS = [u.strip() for u in os.getenv('ADMIN_USERS', 'admin').split(',') if u.strip()]
+
+def admin_required(f):
+    @wraps(f)
+    @login_required
+    def decorated_function(*args, **kwargs):
+        if session.get('username') not in ADMIN_USERS:
+            flash('Administrator access required', 'danger')
+            return redirect(url_for('dashboard'))
+        return f(*args, **kwargs)
+    return decorated_function
+
+# Conditional GET
+# Rendered pages kept per worker, keyed by ETag; 0 disables the page cache
+PAGE_CACHE_ENTRIES = int(os.getenv('PAGE_CACHE_ENTRIES', 0))
+page_cache = OrderedDict()
+page_cache_lock = threading.Lock()
+
+def conditional_get(*versions):
+    """Answer GETs with 304 Not Modified while the given data versions are unchanged.
+
+    The ETag covers the data versions, the full path (search and page
+    arguments), the user and the date. Pages with pending flash messages are
+    always rendered.
+    """
+    def decorator(f):
+        @wraps(f)
+        def decorated_function(*args, **kwargs):
+            if request.method != 'GET' or '_flashes' in session:
+                return f(*args, **kwargs)
+            try:
+                with get_db_cursor(primary=True) as cur:
+                    current = read_data_versions(cur, versions)
+            except Exception as e:
+                logger.error(f"Error reading data versions: {str(e)}")
+                return f(*args, **kwargs)
+            # The body must be at least as new as its ETag, so a lagging replica can't be tagged current
+            g.primary_reads = True
+            etag = hashlib.sha1(repr((
+                request.endpoint, request.full_path, session.get('username'),
+                datetime.now().date().isoformat(), current
+            )).encode()).hexdigest()
+
+            if etag in request.if_none_match:
+                response = make_response('', 304)
+            else:
+                with page_cache_lock:
+                    cached = page_cache.get(etag)
+                    if cached is not None:
+                        page_cache.move_to_end(etag)
+                if cached is not None:
+                    response = make_response(cached)
+                else:
+                    response = make_response(f(*args, **kwargs))
+                    # Error pages flash a message; only cache what rendered cleanly
+                    if response.status_code != 200 or '_flashes' in session or get_flashed_messages():
+                        return response
+                    if PAGE_CACHE_ENTRIES:
+                        with page_cache_lock:
+                            page_cache[etag] = response.get_data()
+                            while len(page_cache) > PAGE_CACHE_ENTRIES:
+                                page_cache.popitem(last=False)
+            response.set_etag(etag)
+            response.headers['Cache-Control'] = 'private, no-cache'
+            return response
+        return decorated_function
+    return decorator
+
 @app.route('/login', methods=['GET', 'POST'])
 def login():
     if request.method == 'POST':
@@ -354,18 +2281,26 @@ def logout():
 @app.route('/')
 @login_required
 def dashboard():
-    return redirect(url_for('view_students'))
+    try:
+        data = get_dashboard_data()
+    except Exception as e:
+        logger.error(f"Error loading dashboard: {str(e)}")
+        flash('Error loading dashboard', 'danger')
+        return redirect(url_for('view_students'))
+
+    return render_template('dashboard.html', **data)
 
 # Student management
 @app.route('/students')
 @login_required
+@conditional_get('students', 'balances')
 def view_students():
     search = request.args.get('search', '')
-    query = 'SELECT s.*, COALESCE(sb.current_balance, 0) AS balance FROM students s LEFT JOIN student_balances sb ON s.id = sb.student_id'
+    query = 'SELECT s.*, COALESCE(sb.current_balance, 0) AS balance FROM students s LEFT JOIN student_balances sb ON s.id = sb.student_id WHERE s.deleted_at IS NULL'
     params = []
     
     if search:
-        query += ' WHERE admission_no ILIKE %s OR name ILIKE %s'
+        query += ' AND (admission_no ILIKE %s OR name ILIKE %s)'
         params.extend([f'%{search}%', f'%{search}%'])
     
     query += ' ORDER BY name'
@@ -433,6 +2368,136 @@ def add_student():
     return render_template('add_student.html')
 
 
+# Bulk admissions
+STUDENT_IMPORT_COLUMNS = ('admission_no', 'name', 'form')
+
+def read_student_rows(filename, stream):
+    """Read admission rows from an uploaded CSV or Excel file as dicts keyed by column"""
+    if filename.lower().endswith(('.xlsx', '.xlsm')):
+        if openpyxl is None:
+            raise ValueError('Excel imports require openpyxl; upload a CSV file instead')
+        sheet = openpyxl.load_workbook(stream, read_only=True, data_only=True).active
+        rows = sheet.iter_rows(values_only=True)
+        header = next(rows, None) or []
+        records = [dict(zip(header, row)) for row in rows]
+    else:
+        text = stream.read()
+        if isinstance(text, bytes):
+            text = text.decode('utf-8-sig')
+        records = list(csv.DictReader(StringIO(text)))
+
+    students = []
+    for record in records:
+        normalized = {str(key).strip().lower().replace(' ', '_'): value
+                      for key, value in record.items() if key is not None}
+        students.append({column: str(normalized.get(column) or '').strip()
+                         for column in STUDENT_IMPORT_COLUMNS})
+    return students
+
+def import_students(rows):
+    """Validate and admit rows in bulk. Returns (imported_count, errors).
+
+    Rows are checked in memory against each other and against existing admission
+    numbers, COPYed into a staging table, merged into students, and given their
+    term and cumulative balances for the open terms with set-based statements in one
+    transaction.
+    """
+    errors = []
+    valid = []
+    seen = set()
+    for row_number, row in enumerate(rows, start=2):  # Row 1 is the header
+        if not all(row[column] for column in STUDENT_IMPORT_COLUMNS):
+            errors.append({'row': row_number, 'admission_no': row['admission_no'], 'error': 'All fields are required'})
+        elif len(row['admission_no']) > 20:
+            errors.append({'row': row_number, 'admission_no': row['admission_no'], 'error': 'Admission number too long (max 20 characters)'})
+        elif row['admission_no'] in seen:
+            errors.append({'row': row_number, 'admission_no': row['admission_no'], 'error': 'Duplicate admission number in file'})
+        else:
+            seen.add(row['admission_no'])
+            valid.append((row_number, row))
+
+    if not valid:
+        return 0, errors
+
+    with get_db_cursor(commit=True) as cur:
+        cur.execute('SELECT admission_no FROM students WHERE admission_no = ANY(%s)',
+                    ([row['admission_no'] for _, row in valid],))
+        existing = {row[0] for row in cur.fetchall()}
+        for row_number, row in valid:
+            if row['admission_no'] in existing:
+                errors.append({'row': row_number, 'admission_no': row['admission_no'], 'error': 'Admission number already exists'})
+        valid = [(row_number, row) for row_number, row in valid if row['admission_no'] not in existing]
+        if not valid:
+            return 0, sorted(errors, key=lambda error: error['row'])
+
+        cur.execute('''
+            CREATE TEMP TABLE student_import (
+                admission_no TEXT NOT NULL,
+                name TEXT NOT NULL,
+                form TEXT NOT NULL
+            ) ON COMMIT DROP
+        ''')
+        buffer = StringIO()
+        writer = csv.writer(buffer)
+        for _, row in valid:
+            writer.writerow([row[column] for column in STUDENT_IMPORT_COLUMNS])
+        buffer.seek(0)
+        cur.copy_expert('COPY student_import (admission_no, name, form) FROM STDIN WITH (FORMAT csv)', buffer)
+
+        cur.execute('CREATE TEMP TABLE imported_students (id INTEGER PRIMARY KEY, admission_no TEXT) ON COMMIT DROP')
+        cur.execute('''
+            WITH inserted AS (
+                INSERT INTO students (admission_no, name, form)
+                SELECT admission_no, name, form FROM student_import
+                ON CONFLICT (admission_no) DO NOTHING
+                RETURNING id, admission_no
+            )
+            INSERT INTO imported_students (id, admission_no)
+            SELECT id, admission_no FROM inserted
+        ''')
+        imported_count = cur.rowcount
+
+        # Admitted concurrently by someone else between the check and the merge
+        if imported_count < len(valid):
+            cur.execute('SELECT admission_no FROM imported_students')
+            inserted = {row[0] for row in cur.fetchall()}
+            for row_number, row in valid:
+                if row['admission_no'] not in inserted:
+                    errors.append({'row': row_number, 'admission_no': row['admission_no'], 'error': 'Admission number already exists'})
+
+        cur.execute('SELECT id FROM imported_students')
+        rebalance_students(cur, [row[0] for row in cur.fetchall()])
+
+    return imported_count, sorted(errors, key=lambda error: error['row'])
+
+@app.route('/students/import', methods=['GET', 'POST'])
+@login_required
+def import_students_view():
+    if request.method == 'POST':
+        upload = request.files.get('file')
+        if not upload or not upload.filename:
+            flash('Choose a CSV or Excel file to import', 'danger')
+            return render_template('import_students.html')
+        
+        try:
+            rows = read_student_rows(upload.filename, upload.stream)
+            imported_count, errors = import_students(rows)
+        except (ValueError, KeyError, csv.Error) as e:
+            flash(f'Could not read file: {str(e)}', 'danger')
+            return render_template('import_students.html')
+        except Exception as e:
+            logger.error(f"Error importing students: {str(e)}", exc_info=True)
+            flash('Error importing students', 'danger')
+            return render_template('import_students.html')
+        
+        flash(f'Imported {imported_count} students, {len(errors)} rows rejected',
+              'success' if not errors else 'warning')
+        return render_template('import_students.html',
+                               imported_count=imported_count,
+                               errors=errors)
+    
+    return render_template('import_students.html')
+
 @app.route('/student/edit/<int:id>', methods=['GET', 'POST'])
 @login_required
 def edit_student(id):
@@ -460,12 +2525,19 @@ def edit_student(id):
         
         try:
             with get_db_cursor(commit=True) as cur:
+                form_changed = form != student['form']
+                if form_changed:
+                    apply_payment_rollups(cur, -1, 'p.student_id = %s', (id,))
+                
                 cur.execute('''
                     UPDATE students 
                     SET name = %s, form = %s, updated_at = CURRENT_TIMESTAMP 
                     WHERE id = %s
                 ''', (name, form, id))
                 
+                if form_changed:
+                    apply_payment_rollups(cur, 1, 'p.student_id = %s', (id,))
+                
                 flash('Student updated successfully!', 'success')
                 return redirect(url_for('view_students'))
                 
@@ -479,8 +2551,12 @@ def edit_student(id):
 def delete_student(id):
     try:
         with get_db_cursor(commit=True) as cur:
-            cur.execute('DELETE FROM students WHERE id = %s', (id,))
-            flash('Student deleted successfully!', 'success')
+            if SOFT_DELETE:
+                soft_delete_student(cur, id)
+            else:
+                delete_student_records(cur, id)
+        invalidate_dashboard_cache()
+        flash('Student deleted successfully!', 'success')
     except Exception as e:
         logger.error(f"Error in delete_student: {str(e)}")
         flash(f'Error deleting student: {str(e)}', 'danger')
@@ -490,17 +2566,16 @@ def delete_student(id):
 # Term management
 @app.route('/terms')
 @login_required
+@conditional_get('terms')
 def view_terms():
     try:
-        with get_db_cursor(dict_cursor=True) as cur:
-            cur.execute('SELECT * FROM terms ORDER BY name')
-            terms = cur.fetchall()
+        terms = get_terms(include_archived=True)
     except Exception as e:
         logger.error(f"Error in view_terms: {str(e)}")
         flash('Error retrieving terms', 'danger')
         terms = []
     
-    return render_template('terms.html', terms=terms)
+    return render_template('terms.html', terms=terms, admin_users=ADMIN_USERS)
 
 @app.route('/term/add', methods=['GET', 'POST'])
 @login_required
@@ -508,6 +2583,7 @@ def add_term():
     if request.method == 'POST':
         name = request.form['name'].strip()
         amount = request.form['amount'].strip()
+        due_date = request.form.get('due_date', '').strip() or None
         
         # Validate inputs
         if not all([name, amount]):
@@ -516,6 +2592,8 @@ def add_term():
         
         try:
             amount = Decimal(amount)
+            if due_date:
+                due_date = datetime.strptime(due_date, '%Y-%m-%d').date()
             if amount <= 0:
                 flash('Amount must be positive', 'danger')
                 return render_template('add_term.html')
@@ -532,15 +2610,16 @@ def add_term():
                 
                 # Insert new term
                 cur.execute('''
-                    INSERT INTO terms (name, amount)
-                    VALUES (%s, %s)
-                ''', (name, amount))
-                
-                flash('Term added successfully!', 'success')
-                return redirect(url_for('view_terms'))
+                    INSERT INTO terms (name, amount, due_date)
+                    VALUES (%s, %s, %s)
+                ''', (name, amount, due_date))
+            invalidate_term_cache()
+            
+            flash('Term added successfully!', 'success')
+            return redirect(url_for('view_terms'))
                 
         except (ValueError, InvalidOperation):
-            flash('Amount must be a valid number', 'danger')
+            flash('Amount must be a valid number and due date a valid date', 'danger')
         except psycopg2.IntegrityError:
             flash('Term name must be unique', 'danger')
         except Exception as e:
@@ -570,6 +2649,7 @@ def edit_term(id):
     if request.method == 'POST':
         name = request.form['name'].strip()
         amount = request.form['amount'].strip()
+        due_date = request.form.get('due_date', '').strip() or None
         
         if not all([name, amount]):
             flash('All fields are required', 'danger')
@@ -577,6 +2657,8 @@ def edit_term(id):
         
         try:
             amount = Decimal(amount)
+            if due_date:
+                due_date = datetime.strptime(due_date, '%Y-%m-%d').date()
             if amount <= 0:
                 flash('Amount must be positive', 'danger')
                 return redirect(url_for('edit_term', id=id))
@@ -597,21 +2679,19 @@ def edit_term(id):
                 # Update term
                 cur.execute('''
                     UPDATE terms 
-                    SET name = %s, amount = %s, updated_at = CURRENT_TIMESTAMP 
+                    SET name = %s, amount = %s, due_date = %s, updated_at = CURRENT_TIMESTAMP 
                     WHERE id = %s
-                ''', (name, amount, id))
+                ''', (name, amount, due_date, id))
                 
                 # Recalculate all student balances
-                cur.execute('SELECT id FROM students')
-                student_ids = [row[0] for row in cur.fetchall()]
-                for student_id in student_ids:
-                    calculate_student_balance(student_id)
-                
-                flash('Term updated successfully!', 'success')
-                return redirect(url_for('view_terms'))
+                rebalance_students(cur)
+            invalidate_term_cache()
+            
+            flash('Term updated successfully!', 'success')
+            return redirect(url_for('view_terms'))
                 
         except (ValueError, InvalidOperation):
-            flash('Amount must be a valid number', 'danger')
+            flash('Amount must be a valid number and due date a valid date', 'danger')
         except psycopg2.IntegrityError:
             flash('Term name must be unique', 'danger')
         except Exception as e:
@@ -624,25 +2704,56 @@ def edit_term(id):
 def delete_term(id):
     try:
         with get_db_cursor(commit=True) as cur:
-            cur.execute('DELETE FROM terms WHERE id = %s', (id,))
-            flash('Term deleted successfully!', 'success')
+            if SOFT_DELETE:
+                soft_delete_term(cur, id)
+            else:
+                delete_term_records(cur, id)
+        invalidate_term_cache()
+        invalidate_dashboard_cache()
+        flash('Term deleted successfully!', 'success')
     except Exception as e:
         logger.error(f"Error in delete_term: {str(e)}")
         flash(f'Error deleting term: {str(e)}', 'danger')
     
     return redirect(url_for('view_terms'))
 
+@app.route('/admin/rollover', methods=['GET', 'POST'])
+@admin_required
+def academic_year_rollover():
+    if request.method == 'POST':
+        closing_year = request.form.get('closing_year', '').strip()
+        new_year = request.form.get('new_year', '').strip()
+        if not closing_year or not new_year or closing_year == new_year:
+            flash('Enter the academic year being closed and the new academic year', 'danger')
+            return redirect(url_for('academic_year_rollover'))
+        try:
+            summary = rollover_academic_year(closing_year, new_year)
+        except Exception as e:
+            logger.error(f"Error in academic_year_rollover: {str(e)}")
+            flash(f'Error rolling over academic year: {str(e)}', 'danger')
+            return redirect(url_for('academic_year_rollover'))
+        if summary is None:
+            flash(f'Academic year {closing_year} has already been closed', 'warning')
+        else:
+            flash(f"Closed {closing_year}: promoted {summary['promoted']} students, "
+                  f"graduated {summary['graduated']}, carried forward {summary['carried_forward']} balances", 'success')
+        return redirect(url_for('view_terms'))
+
+    forms, years = rollover_preview()
+    return render_template('rollover.html', forms=forms, years=years, form_sequence=FORM_SEQUENCE)
+
 # Payment management
 @app.route('/payments')
 @login_required
+@conditional_get('payments', 'students', 'terms')
 def view_payments():
     search = request.args.get('search', '')
     query = '''
-        SELECT p.id, p.amount_paid, p.payment_date, p.receipt_number,
+        SELECT p.id, p.amount_paid, p.payment_date, p.receipt_number, p.updated_at,
                s.name AS student_name, s.admission_no,
                t.name AS term_name
         FROM payments p
-        JOIN students s ON p.student_id = s.id
+        JOIN students s ON p.student_id = s.id AND s.deleted_at IS NULL
         JOIN terms t ON p.term_id = t.id
     '''
     params = []
@@ -663,44 +2774,284 @@ def view_payments():
         payments = []
     
     return render_template('payments.html', payments=payments, search=search)
+# Payment exports
+EXPORT_DIR = os.getenv('EXPORT_DIR', 'exports')
+EXPORT_PDF_SYNC_ROWS = int(os.getenv('EXPORT_PDF_SYNC_ROWS', 500))
+PDF_WORKERS = int(os.getenv('PDF_WORKERS', 2))
+
+# Shared by every background PDF job so rendering never exceeds PDF_WORKERS threads
+pdf_executor = ThreadPoolExecutor(max_workers=PDF_WORKERS, thread_name_prefix='pdf')
+
+PAYMENT_EXPORT_QUERY = '''
+    SELECT p.id, p.receipt_number, s.name AS student_name, s.admission_no,
+           t.name AS term_name, p.amount_paid, p.payment_date
+    FROM payments p
+    JOIN students s ON p.student_id = s.id AND s.deleted_at IS NULL
+    JOIN terms t ON p.term_id = t.id
+'''
+
+def payment_export_filters(args):
+    """Build the WHERE clause shared by the CSV, printable and PDF exports"""
+    conditions = []
+    params = []
+
+    admission_no = args.get('admission_no', '').strip()
+    if admission_no:
+        conditions.append('s.admission_no = %s')
+        params.append(admission_no)
+
+    term = args.get('term', '').strip()
+    if term:
+        if term.isdigit():
+            conditions.append('t.id = %s')
+            params.append(int(term))
+        else:
+            conditions.append('t.name = %s')
+            params.append(term)
+
+    for arg, condition in (('date_from', 'p.payment_date >= %s'), ('date_to', 'p.payment_date <= %s')):
+        value = args.get(arg, '').strip()
+        if value:
+            conditions.append(condition)
+            params.append(datetime.strptime(value, '%Y-%m-%d').date())
+
+    where = ' WHERE ' + ' AND '.join(conditions) if conditions else ''
+    return where, params
+
+def fetch_payments_for_export(args):
+    where, params = payment_export_filters(args)
+    with get_db_cursor(dict_cursor=True) as cur:
+        cur.execute(PAYMENT_EXPORT_QUERY + where + ' ORDER BY p.payment_date, p.id', params)
+        return cur.fetchall()
+
+def render_payments_pdf(args, base_url):
+    with app.test_request_context('/payments/export/pdf', query_string=args, base_url=base_url):
+        html = render_template('payments_printable.html',
+                               payments=fetch_payments_for_export(args),
+                               pdf=True)
+        return HTML(string=html, base_url=base_url).write_pdf()
+
+def run_payments_pdf_job(job_id, args, base_url):
+    """Render a large export in the background; the job page polls for the file"""
+    path = os.path.join(EXPORT_DIR, job_id)
+    try:
+        pdf_bytes = render_payments_pdf(args, base_url)
+        with open(path + '.tmp', 'wb') as pdf_file:
+            pdf_file.write(pdf_bytes)
+        os.replace(path + '.tmp', path + '.pdf')
+    except Exception as e:
+        logger.error(f"Error rendering payments export {job_id}: {str(e)}", exc_info=True)
+        with open(path + '.error', 'w') as error_file:
+            error_file.write(str(e))
+
+@app.route('/payments/export.csv')
+@login_required
+def export_payments_csv():
+    try:
+        where, params = payment_export_filters(request.args)
+    except ValueError:
+        flash('Invalid date format', 'danger')
+        return redirect(url_for('view_payments'))
+
+    def generate():
+        buffer = StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(['Receipt No', 'Student Name', 'Admission No', 'Term', 'Amount Paid', 'Date'])
+        # A named cursor streams the ledger in STREAM_BATCH_SIZE chunks, so memory stays flat
+        with get_db_cursor(name='payments_export') as cur:
+            cur.execute(PAYMENT_EXPORT_QUERY + where + ' ORDER BY p.payment_date, p.id', params)
+            for row in cur:
+                writer.writerow([row[1], row[2], row[3], row[4], row[5], row[6].isoformat()])
+                if buffer.tell() > 64 * 1024:
+                    yield buffer.getvalue()
+                    buffer.seek(0)
+                    buffer.truncate()
+        yield buffer.getvalue()
+
+    response = Response(stream_with_context(generate()), mimetype='text/csv')
+    response.headers['Content-Disposition'] = f'attachment; filename=payments_{datetime.now().strftime("%Y%m%d")}.csv'
+    return response
+
+# Payment journal reader for auditors
+PAYMENT_EVENTS_QUERY = '''
+    SELECT e.id, e.recorded_at, e.recorded_by, e.event_type, e.payment_id, e.receipt_number,
+           s.admission_no, e.student_id, t.name AS term_name, e.term_id, e.amount, e.payment_date
+    FROM payment_events e
+    LEFT JOIN students s ON s.id = e.student_id
+    LEFT JOIN terms t ON t.id = e.term_id
+'''
+
+def payment_event_filters(args):
+    """WHERE clause for the journal reader; after_id lets auditors resume a download"""
+    conditions = []
+    params = []
+    after_id = args.get('after_id', '').strip()
+    if after_id:
+        conditions.append('e.id > %s')
+        params.append(int(after_id))
+    admission_no = args.get('admission_no', '').strip()
+    if admission_no:
+        conditions.append('e.student_id = (SELECT id FROM students WHERE admission_no = %s)')
+        params.append(admission_no)
+    receipt_number = args.get('receipt_number', '').strip()
+    if receipt_number:
+        conditions.append('e.receipt_number = %s')
+        params.append(receipt_number)
+    for arg, condition in (('date_from', 'e.recorded_at >= %s'), ('date_to', 'e.recorded_at < %s')):
+        value = args.get(arg, '').strip()
+        if value:
+            day = datetime.strptime(value, '%Y-%m-%d')
+            conditions.append(condition)
+            params.append(day + timedelta(days=1) if arg == 'date_to' else day)
+    where = ' WHERE ' + ' AND '.join(conditions) if conditions else ''
+    return where, params
+
+@app.route('/admin/payment-events.csv')
+@admin_required
+def export_payment_events():
+    try:
+        where, params = payment_event_filters(request.args)
+    except ValueError:
+        flash('Invalid filter value', 'danger')
+        return redirect(url_for('view_payments'))
+
+    def generate():
+        buffer = StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(['Event ID', 'Recorded At', 'Recorded By', 'Event', 'Payment ID', 'Receipt No',
+                         'Admission No', 'Student ID', 'Term', 'Term ID', 'Amount', 'Payment Date'])
+        # Ordered by the primary key, so the named cursor walks the index without sorting
+        with get_db_cursor(name='payment_events_export') as cur:
+            cur.execute(PAYMENT_EVENTS_QUERY + where + ' ORDER BY e.id', params)
+            for row in cur:
+                writer.writerow([row[0], row[1].isoformat(sep=' ', timespec='seconds'), row[2], row[3], row[4],
+                                 row[5], row[6], row[7], row[8], row[9], row[10], row[11].isoformat()])
+                if buffer.tell() > 64 * 1024:
+                    yield buffer.getvalue()
+                    buffer.seek(0)
+                    buffer.truncate()
+        yield buffer.getvalue()
+
+    response = Response(stream_with_context(generate()), mimetype='text/csv')
+    response.headers['Content-Disposition'] = f'attachment; filename=payment_events_{datetime.now().strftime("%Y%m%d")}.csv'
+    return response
+
+@app.route('/payments/printable')
+@login_required
+def payments_printable():
+    try:
+        payments = fetch_payments_for_export(request.args)
+    except ValueError:
+        flash('Invalid date format', 'danger')
+        return redirect(url_for('view_payments'))
+    except Exception as e:
+        logger.error(f"Error in payments_printable: {str(e)}")
+        flash('Error retrieving payments', 'danger')
+        return redirect(url_for('view_payments'))
+
+    return render_template('payments_printable.html', payments=payments)
+
+@app.route('/payments/export/pdf')
+@login_required
+def export_payments_pdf():
+    args = request.args.to_dict()
+    try:
+        where, params = payment_export_filters(args)
+        with get_db_cursor() as cur:
+            cur.execute('SELECT COUNT(*) FROM payments p '
+                        'JOIN students s ON p.student_id = s.id AND s.deleted_at IS NULL '
+                        'JOIN terms t ON p.term_id = t.id' + where, params)
+            row_count = cur.fetchone()[0]
+
+        if row_count <= EXPORT_PDF_SYNC_ROWS:
+            response = make_response(render_payments_pdf(args, request.host_url))
+            response.headers['Content-Type'] = 'application/pdf'
+            response.headers['Content-Disposition'] = 'inline; filename=Payments.pdf'
+            return response
+
+        os.makedirs(EXPORT_DIR, exist_ok=True)
+        job_id = uuid.uuid4().hex
+        pdf_executor.submit(run_payments_pdf_job, job_id, args, request.host_url)
+        flash(f'Exporting {row_count} payments in the background', 'info')
+        return redirect(url_for('export_job_status', job_id=job_id))
+
+    except ValueError:
+        flash('Invalid date format', 'danger')
+    except Exception as e:
+        logger.error(f"Error exporting payments PDF: {str(e)}", exc_info=True)
+        flash('Error exporting payments', 'danger')
+    return redirect(url_for('view_payments'))
+
+@app.route('/payments/export/jobs/<job_id>')
+@login_required
+def export_job_status(job_id):
+    if not re.fullmatch(r'[0-9a-f]{32}', job_id):
+        flash('Export not found', 'danger')
+        return redirect(url_for('view_payments'))
+
+    path = os.path.join(EXPORT_DIR, job_id)
+    if os.path.exists(path + '.pdf'):
+        return send_file(os.path.abspath(path + '.pdf'), mimetype='application/pdf',
+                         download_name='Payments.pdf')
+    if os.path.exists(path + '.error'):
+        flash('Error exporting payments', 'danger')
+        return redirect(url_for('view_payments'))
+    return render_template('export_job.html', job_id=job_id)
+
+STUDENT_LOOKUP_SQL = '''
+    SELECT id FROM students 
+    WHERE (admission_no = %s OR name ILIKE %s) AND deleted_at IS NULL
+    LIMIT 1
+'''
+
 @app.route('/payment/add', methods=['GET', 'POST'])
 @login_required
 def add_payment():
     # Get terms for dropdown
     try:
-        with get_db_cursor(dict_cursor=True) as cur:
-            cur.execute('SELECT id, name, amount FROM terms ORDER BY name')
-            terms = cur.fetchall()
+        terms = get_terms()
     except Exception as e:
         logger.error(f"Error loading terms: {str(e)}")
+        if OFFLINE_CASHIER and isinstance(e, (psycopg2.OperationalError, pool.PoolError)):
+            flash('The database is unreachable; payments are being recorded offline', 'warning')
+            return redirect(url_for('offline_add_payment'))
         flash('Error loading payment form', 'danger')
         return redirect(url_for('view_payments'))
 
+    # Each rendered form carries a token; resubmitting it returns the first result
+    submission_token = request.form.get('submission_token', '')
+    if not SUBMISSION_TOKEN_RE.fullmatch(submission_token):
+        submission_token = None
+
     if request.method == 'POST':
         student_identifier = request.form.get('student_identifier', '').strip()
         term_id = request.form.get('term_id')
         amount_paid = request.form.get('amount_paid')
         payment_date = request.form.get('payment_date')
         
+        if submission_token:
+            with get_db_cursor(primary=True) as cur:
+                original = find_submission(cur, submission_token)
+            if original:
+                return redirect_to_submitted_payment(original)
+        
         # Validate inputs
         if not all([student_identifier, term_id, amount_paid, payment_date]):
             flash('All fields are required', 'danger')
             return render_template('add_payment.html', 
                                 terms=terms,
                                 default_date=datetime.now().strftime('%Y-%m-%d'),
-                                form_data=request.form)
+                                form_data=request.form,
+                                submission_token=submission_token or uuid.uuid4().hex)
 
         try:
             amount_paid = Decimal(amount_paid)
             payment_date = datetime.strptime(payment_date, '%Y-%m-%d').date()
             
+            original = None
             with get_db_cursor(commit=True) as cur:
                 # Find student (using tuple access)
-                cur.execute('''
-                    SELECT id FROM students 
-                    WHERE admission_no = %s OR name ILIKE %s
-                    LIMIT 1
-                ''', (student_identifier, f'%{student_identifier}%'))
+                execute_prepared(cur, STUDENT_LOOKUP_SQL, (student_identifier, f'%{student_identifier}%'))
                 student = cur.fetchone()
                 
                 if not student:
@@ -708,30 +3059,25 @@ def add_payment():
                     return render_template('add_payment.html',
                                         terms=terms,
                                         default_date=datetime.now().strftime('%Y-%m-%d'),
-                                        form_data=request.form)
+                                        form_data=request.form,
+                                        submission_token=submission_token or uuid.uuid4().hex)
                 
                 student_id = student[0]  # Access first element of tuple
                 
-                # Generate receipt number
-                receipt_number = generate_receipt_number()
-                
-                # Insert payment
-                cur.execute('''
-                    INSERT INTO payments 
-                    (student_id, term_id, amount_paid, payment_date, receipt_number)
-                    VALUES (%s, %s, %s, %s, %s)
-                ''', (student_id, term_id, amount_paid, payment_date, receipt_number))
-                
-                # Update balances
-                try:
-                    term_balance = calculate_term_balance(student_id, term_id)
-                    cumulative_balance = calculate_cumulative_balance(student_id)
-                    flash(f'Payment recorded. Term balance: KSh {term_balance:,.2f}, Cumulative balance: KSh {cumulative_balance:,.2f}', 'success')
-                except Exception as e:
-                    logger.error(f"Balance update failed: {str(e)}")
-                    flash('Payment recorded but balance update failed', 'warning')
-                
-                return redirect(url_for('view_payments'))
+                if submission_token and not claim_submission(cur, submission_token):
+                    # A retry that raced the original submission; it has committed by now
+                    original = find_submission(cur, submission_token)
+                else:
+                    # Insert payment and update balances in the same transaction
+                    payment = record_payment(cur, student_id, int(term_id), amount_paid, payment_date)
+                    if submission_token:
+                        save_submission(cur, submission_token, payment)
+            
+            if original:
+                return redirect_to_submitted_payment(original)
+            flash(f"Payment recorded. Term balance: KSh {payment['term_balance']:,.2f}, "
+                  f"Cumulative balance: KSh {payment['cumulative_balance']:,.2f}", 'success')
+            return redirect(url_for('view_payments'))
                 
         except ValueError:
             flash('Invalid date or amount format', 'danger')
@@ -742,7 +3088,160 @@ def add_payment():
     # GET request
     return render_template('add_payment.html', 
                          terms=terms,
-                         default_date=datetime.now().strftime('%Y-%m-%d'))
+                         default_date=datetime.now().strftime('%Y-%m-%d'),
+                         form_data=request.form if request.method == 'POST' else None,
+                         submission_token=submission_token or uuid.uuid4().hex)
+
+def redirect_to_submitted_payment(original):
+    """Answer a repeated submission with the payment the first one recorded"""
+    flash(f"This payment was already recorded (receipt {original['receipt_number']}). "
+          f"Term balance: KSh {original['term_balance']:,.2f}, "
+          f"Cumulative balance: KSh {original['cumulative_balance']:,.2f}", 'info')
+    return redirect(url_for('view_payments'))
+
+# Offline cashier desk
+def offline_cashier_required(f):
+    @wraps(f)
+    @login_required
+    def decorated_function(*args, **kwargs):
+        if not OFFLINE_CASHIER:
+            flash('Offline cashier mode is not enabled', 'danger')
+            return redirect(url_for('add_payment'))
+        return f(*args, **kwargs)
+    return decorated_function
+
+@app.route('/offline/payment', methods=['GET', 'POST'])
+@offline_cashier_required
+def offline_add_payment():
+    with get_local_cursor(dict_cursor=True) as cur:
+        cur.execute('SELECT id, name, amount FROM terms ORDER BY name')
+        terms = cur.fetchall()
+        cur.execute('SELECT admission_no, name FROM students ORDER BY name')
+        students = cur.fetchall()
+
+    submission_token = request.form.get('submission_token', '')
+    if not SUBMISSION_TOKEN_RE.fullmatch(submission_token):
+        submission_token = uuid.uuid4().hex
+
+    if request.method == 'POST':
+        student_identifier = request.form.get('student_identifier', '').strip()
+        term_id = request.form.get('term_id')
+        amount_paid = request.form.get('amount_paid')
+        payment_date = request.form.get('payment_date')
+        error = None
+        try:
+            amount_paid = Decimal(amount_paid or '')
+            payment_date = datetime.strptime(payment_date or '', '%Y-%m-%d').date()
+            with get_local_cursor() as cur:
+                cur.execute('''
+                    SELECT id FROM students
+                    WHERE admission_no = ? OR name LIKE ?
+                    ORDER BY admission_no = ? DESC
+                    LIMIT 1
+                ''', (student_identifier, f'%{student_identifier}%', student_identifier))
+                student = cur.fetchone()
+                cur.execute('SELECT 1 FROM terms WHERE id = ?', (term_id,))
+                term = cur.fetchone()
+            if not student_identifier or not student:
+                error = 'Student not found in the offline list'
+            elif not term:
+                error = 'Term not found in the offline list'
+            elif amount_paid <= 0:
+                error = 'Amount must be positive'
+            else:
+                local_id = record_offline_payment(student[0], int(term_id), amount_paid, payment_date,
+                                                  submission_token, session.get('username'))
+                return redirect(url_for('offline_receipt', local_id=local_id))
+        except (ValueError, InvalidOperation):
+            error = 'Invalid date or amount format'
+        except Exception as e:
+            logger.error(f"Error recording offline payment: {str(e)}")
+            error = 'Error recording offline payment'
+        flash(error, 'danger')
+
+    return render_template('offline_payment.html',
+                           terms=terms,
+                           students=students,
+                           default_date=datetime.now().strftime('%Y-%m-%d'),
+                           form_data=request.form if request.method == 'POST' else None,
+                           submission_token=submission_token)
+
+@app.route('/offline/receipt/<int:local_id>')
+@offline_cashier_required
+def offline_receipt(local_id):
+    with get_local_cursor(dict_cursor=True) as cur:
+        cur.execute('''
+            SELECT p.*, s.name AS student_name, s.admission_no, s.form, s.current_balance,
+                   t.name AS term_name,
+                   (SELECT COALESCE(SUM(q.amount_paid), 0) FROM payments q
+                    WHERE q.student_id = p.student_id AND q.synced_at IS NULL) AS unsynced_paid
+            FROM payments p
+            LEFT JOIN students s ON s.id = p.student_id
+            LEFT JOIN terms t ON t.id = p.term_id
+            WHERE p.id = ?
+        ''', (local_id,))
+        payment = cur.fetchone()
+    if not payment:
+        flash('Offline receipt not found', 'danger')
+        return redirect(url_for('offline_status'))
+    balance = None
+    if payment['current_balance'] is not None:
+        balance = local_money(payment['current_balance']) - local_money(payment['unsynced_paid'])
+    return render_template('offline_receipt.html',
+                           payment=payment,
+                           amount_paid=local_money(payment['amount_paid']),
+                           balance=balance,
+                           logo_base64=get_logo_base64())
+
+@app.route('/offline')
+@offline_cashier_required
+def offline_status():
+    with get_local_cursor(dict_cursor=True) as cur:
+        cur.execute('''
+            SELECT COUNT(*) FILTER (WHERE synced_at IS NULL AND sync_error IS NULL) AS pending,
+                   COUNT(*) FILTER (WHERE synced_at IS NOT NULL) AS synced,
+                   COUNT(*) FILTER (WHERE sync_error IS NOT NULL) AS conflicts
+            FROM payments
+        ''')
+        counts = cur.fetchone()
+        cur.execute('''
+            SELECT p.id, p.receipt_number, p.amount_paid, p.payment_date, p.recorded_at, p.synced_at,
+                   p.remote_payment_id, p.sync_error, s.admission_no, s.name AS student_name, t.name AS term_name
+            FROM payments p
+            LEFT JOIN students s ON s.id = p.student_id
+            LEFT JOIN terms t ON t.id = p.term_id
+            WHERE p.synced_at IS NULL OR p.synced_at >= ?
+            ORDER BY p.sync_error IS NULL, p.id DESC
+            LIMIT 200
+        ''', ((datetime.now() - timedelta(days=1)).isoformat(timespec='seconds'),))
+        payments = cur.fetchall()
+    return render_template('offline_status.html', counts=counts, payments=payments, device_id=OFFLINE_DEVICE_ID)
+
+@app.route('/offline/sync', methods=['POST'])
+@offline_cashier_required
+def offline_sync_now():
+    try:
+        totals = sync_offline()
+    except (psycopg2.OperationalError, pool.PoolError) as e:
+        logger.warning(f"Offline sync failed: {str(e)}")
+        flash('The database is still unreachable; payments stay queued', 'warning')
+        return redirect(url_for('offline_status'))
+    except Exception as e:
+        logger.error(f"Offline sync failed: {str(e)}", exc_info=True)
+        flash('Error syncing offline payments', 'danger')
+        return redirect(url_for('offline_status'))
+    flash(f"Synced {totals['synced']} payments ({totals['duplicate']} already recorded, "
+          f"{totals['conflict']} conflicts)", 'success' if not totals['conflict'] else 'warning')
+    return redirect(url_for('offline_status'))
+
+@app.route('/offline/payment/<int:local_id>/retry', methods=['POST'])
+@offline_cashier_required
+def retry_offline_payment(local_id):
+    """Put a conflicted payment back in the queue once the cause is fixed"""
+    with get_local_cursor(commit=True) as cur:
+        cur.execute('UPDATE payments SET sync_error = NULL WHERE id = ? AND synced_at IS NULL', (local_id,))
+    flash('Payment queued for the next sync', 'info')
+    return redirect(url_for('offline_status'))
 @app.route('/student/<int:student_id>/balances')
 @login_required
 def view_student_balances(student_id):
@@ -764,6 +3263,7 @@ def view_student_balances(student_id):
                        t.amount - COALESCE(tb.balance, t.amount) as paid
                 FROM terms t
                 LEFT JOIN term_balances tb ON t.id = tb.term_id AND tb.student_id = %s
+                WHERE NOT t.is_archived
                 ORDER BY t.id
             ''', (student_id,))
             term_balances = cur.fetchall()
@@ -791,8 +3291,7 @@ def view_term_balance(student_id, term_id):
             cur.execute('SELECT id, name FROM students WHERE id = %s', (student_id,))
             student = cur.fetchone()
             
-            cur.execute('SELECT id, name, amount FROM terms WHERE id = %s', (term_id,))
-            term = cur.fetchone()
+            term = get_term(term_id)
             
             if not student or not term:
                 flash('Student or term not found', 'danger')
@@ -832,7 +3331,7 @@ def search_students():
             cur.execute('''
                 SELECT id, name, admission_no 
                 FROM students 
-                WHERE admission_no ILIKE %s OR name ILIKE %s
+                WHERE (admission_no ILIKE %s OR name ILIKE %s) AND deleted_at IS NULL
                 ORDER BY name
                 LIMIT 10
             ''', (f'%{query}%', f'%{query}%'))
@@ -845,7 +3344,7 @@ def search_students():
 @login_required
 def edit_payment(id):
     if request.method == 'POST':
-        student_id = request.form['student_id']
+        student_id = int(request.form['student_id'])
         term_id = request.form['term_id']
         amount_paid = request.form['amount_paid']
         payment_date = request.form['payment_date']
@@ -862,6 +3361,9 @@ def edit_payment(id):
                 # Get old student ID for balance recalculation
                 cur.execute('SELECT student_id FROM payments WHERE id = %s', (id,))
                 old_student_id = cur.fetchone()[0]
+                lock_student_balances(cur, [old_student_id, student_id])
+                apply_payment_rollups(cur, -1, 'p.id = %s', (id,))
+                journal_payments(cur, -1, 'p.id = %s', (id,))
                 
                 # Update payment
                 cur.execute('''
@@ -871,11 +3373,11 @@ def edit_payment(id):
                         updated_at = CURRENT_TIMESTAMP
                     WHERE id = %s
                 ''', (student_id, term_id, amount_paid, payment_date, id))
+                apply_payment_rollups(cur, 1, 'p.id = %s', (id,))
+                journal_payments(cur, 1, 'p.id = %s', (id,))
                 
                 # Recalculate balances for both old and new student
-                calculate_student_balance(old_student_id)
-                if old_student_id != student_id:
-                    calculate_student_balance(student_id)
+                rebalance_students(cur, list({old_student_id, student_id}))
                 
                 flash('Payment updated successfully!', 'success')
                 return redirect(url_for('view_payments'))
@@ -902,11 +3404,10 @@ def edit_payment(id):
                 flash('Payment not found', 'danger')
                 return redirect(url_for('view_payments'))
             
-            cur.execute('SELECT id, name FROM students ORDER BY name')
+            cur.execute('SELECT id, name FROM students WHERE deleted_at IS NULL ORDER BY name')
             students = cur.fetchall()
             
-            cur.execute('SELECT id, name FROM terms ORDER BY name')
-            terms = cur.fetchall()
+            terms = get_terms()
             
             return render_template('edit_payment.html',
                                 payment=payment,
@@ -934,6 +3435,7 @@ def delete_payment(id):
                 
             # Access the student_id from the tuple (index 0)
             student_id = payment[0]
+            lock_student_balances(cur, [student_id])
             
             # Delete payment allocations first
             try:
@@ -942,59 +3444,13 @@ def delete_payment(id):
                 logger.warning(f"Could not delete payment allocations: {str(e)}")
             
             # Delete the payment
+            apply_payment_rollups(cur, -1, 'p.id = %s', (id,))
+            journal_payments(cur, -1, 'p.id = %s', (id,))
             cur.execute('DELETE FROM payments WHERE id = %s', (id,))
             
             # Recalculate balances
             try:
-                # Get all terms
-                cur.execute('SELECT id FROM terms')
-                terms = cur.fetchall()
-                
-                # Calculate balance for each term
-                for term in terms:
-                    term_id = term[0]  # Access term ID from tuple
-                    
-                    # Get total paid for this term
-                    cur.execute('''
-                        SELECT COALESCE(SUM(amount_paid), 0) 
-                        FROM payments 
-                        WHERE student_id = %s AND term_id = %s
-                    ''', (student_id, term_id))
-                    total_paid = cur.fetchone()[0] or Decimal('0')
-                    
-                    # Get term amount
-                    cur.execute('SELECT amount FROM terms WHERE id = %s', (term_id,))
-                    term_amount = cur.fetchone()[0] or Decimal('0')
-                    
-                    # Update term balance
-                    term_balance = term_amount - total_paid
-                    cur.execute('''
-                        INSERT INTO term_balances (student_id, term_id, balance)
-                        VALUES (%s, %s, %s)
-                        ON CONFLICT (student_id, term_id) DO UPDATE
-                        SET balance = EXCLUDED.balance
-                    ''', (student_id, term_id, term_balance))
-                
-                # Update overall balance
-                cur.execute('''
-                    SELECT COALESCE(SUM(amount), 0) FROM terms
-                ''')
-                total_fees = cur.fetchone()[0] or Decimal('0')
-                
-                cur.execute('''
-                    SELECT COALESCE(SUM(amount_paid), 0) 
-                    FROM payments 
-                    WHERE student_id = %s
-                ''', (student_id,))
-                total_paid = cur.fetchone()[0] or Decimal('0')
-                
-                overall_balance = total_fees - total_paid
-                cur.execute('''
-                    INSERT INTO student_balances (student_id, current_balance)
-                    VALUES (%s, %s)
-                    ON CONFLICT (student_id) DO UPDATE
-                    SET current_balance = EXCLUDED.current_balance
-                ''', (student_id, overall_balance))
+                rebalance_students(cur, [student_id])
                 
             except Exception as e:
                 logger.error(f"Error recalculating balances: {str(e)}")
@@ -1008,34 +3464,123 @@ def delete_payment(id):
         logger.error(f"Error in delete_payment: {str(e)}")
         flash(f'Error deleting payment: {str(e)}', 'danger')
         return redirect(url_for('view_payments'))
+# Document verification
+# QR codes carry a short signed URL instead of the document's contents
+QR_SIGNING_KEY = os.getenv('QR_SIGNING_KEY', app.secret_key)
+# Host printed into QR codes, e.g. https://fees.example.ac.ke; defaults to the requesting host
+PUBLIC_BASE_URL = os.getenv('PUBLIC_BASE_URL', '').rstrip('/')
+DOCUMENT_KINDS = {'r': 'receipt', 'n': 'notice'}
+DOCUMENT_TOKEN_RE = re.compile(r'^([rn])([0-9a-z]+)\.([A-Za-z0-9_-]{16})$')
+
+def document_signature(kind, doc_id):
+    digest = hmac.new(QR_SIGNING_KEY.encode(), f'{kind}{doc_id}'.encode(), hashlib.sha256).digest()
+    return base64.urlsafe_b64encode(digest[:12]).decode()
+
+def sign_document(kind, doc_id):
+    """Compact token for a receipt ('r') or notice ('n'): kind, base-36 id and a truncated HMAC"""
+    doc_id = int(doc_id)
+    digits, remaining = '', doc_id
+    while True:
+        remaining, digit = divmod(remaining, 36)
+        digits = '0123456789abcdefghijklmnopqrstuvwxyz'[digit] + digits
+        if not remaining:
+            break
+    return f'{kind}{digits}.{document_signature(kind, doc_id)}'
+
+def verify_document_token(token):
+    """Return (kind, id) for a valid token, else None"""
+    match = DOCUMENT_TOKEN_RE.match(token)
+    if not match:
+        return None
+    kind, digits, signature = match.groups()
+    doc_id = int(digits, 36)
+    if not hmac.compare_digest(signature, document_signature(kind, doc_id)):
+        return None
+    return kind, doc_id
+
+def verification_url(kind, doc_id):
+    token = sign_document(kind, doc_id)
+    if PUBLIC_BASE_URL:
+        return PUBLIC_BASE_URL + url_for('verify_document', token=token)
+    return url_for('verify_document', token=token, _external=True)
+
+def make_qr_base64(data):
+    """PNG QR code as base64; short payloads keep the QR version (and render time) low"""
+    qr = qrcode.QRCode(error_correction=qrcode.constants.ERROR_CORRECT_M, box_size=8, border=2)
+    qr.add_data(data)
+    qr.make(fit=True)
+    qr_buffer = BytesIO()
+    qr.make_image().save(qr_buffer, format="PNG")
+    return base64.b64encode(qr_buffer.getvalue()).decode('utf-8')
+
+@app.route('/verify/<token>')
+def verify_document(token):
+    """Public page a scanned QR code opens; shows the live record behind a receipt or notice"""
+    verified = verify_document_token(token)
+    if not verified:
+        return render_template('verify.html', valid=False), 404
+    kind, doc_id = verified
+    record = None
+    try:
+        with get_db_cursor(dict_cursor=True) as cur:
+            if kind == 'r':
+                for source in payment_ledger_tables(cur):
+                    execute_prepared(cur, RECEIPT_PAYMENT_SQL.format(source=source), (doc_id,))
+                    record = cur.fetchone()
+                    if record:
+                        break
+            else:
+                cur.execute('''
+                    SELECT obn.reference_number, obn.amount, obn.issued_date, obn.due_date,
+                           obn.is_paid, obn.paid_date, s.name AS student_name, s.admission_no, s.form
+                    FROM outstanding_balance_notices obn
+                    JOIN students s ON obn.student_id = s.id
+                    WHERE obn.id = %s
+                ''', (doc_id,))
+                record = cur.fetchone()
+    except Exception as e:
+        logger.error(f"Error in verify_document: {str(e)}")
+        return render_template('verify.html', valid=False, error=True), 500
+    if not record:
+        return render_template('verify.html', valid=False, kind=DOCUMENT_KINDS[kind]), 404
+    return render_template('verify.html', valid=True, kind=DOCUMENT_KINDS[kind], record=record)
+
+RECEIPT_PAYMENT_SQL = '''
+    SELECT 
+        p.id, 
+        p.student_id, 
+        p.amount_paid, 
+        p.payment_date, 
+        p.receipt_number,
+        s.name AS student_name, 
+        s.admission_no, 
+        s.form
+    FROM {source} p
+    JOIN students s ON p.student_id = s.id
+    WHERE p.id = %s
+'''
+
 @app.route('/receipt/<int:payment_id>')
 def view_receipt(payment_id):
     """View payment receipt with detailed allocation information"""
     try:
         with get_db_cursor(dict_cursor=True) as cur:
-            # Get payment details with student information
-            cur.execute('''
-                SELECT 
-                    p.id, 
-                    p.student_id, 
-                    p.amount_paid, 
-                    p.payment_date, 
-                    p.receipt_number,
-                    s.name AS student_name, 
-                    s.admission_no, 
-                    s.form
-                FROM payments p
-                JOIN students s ON p.student_id = s.id
-                WHERE p.id = %s
-            ''', (payment_id,))
-            payment = cur.fetchone()
+            # Get payment details with student information, falling back to archived years
+            payment = None
+            cur.execute("SELECT to_regclass('payments_archive') IS NOT NULL")
+            sources = ['payments', 'payments_archive'] if cur.fetchone()[0] else ['payments']
+            for source in sources:
+                execute_prepared(cur, RECEIPT_PAYMENT_SQL.format(source=source), (payment_id,))
+                payment = cur.fetchone()
+                if payment:
+                    break
             
             if not payment:
                 flash('Receipt not found', 'danger')
                 return redirect(url_for('view_payments'))
 
             # Get payment allocations across terms
-            cur.execute('''
+            execute_prepared(cur, f'''
                 SELECT 
                     pa.term_id,
                     t.name AS term_name,
@@ -1043,7 +3588,7 @@ def view_receipt(payment_id):
                     pa.amount AS allocated_amount,
                     (SELECT COALESCE(SUM(pa2.amount), 0) 
                      FROM payment_allocations pa2 
-                     JOIN payments p2 ON pa2.payment_id = p2.id 
+                     JOIN {source} p2 ON pa2.payment_id = p2.id 
                      WHERE p2.student_id = %s AND pa2.term_id = pa.term_id
                      AND p2.id <= %s) AS running_total
                 FROM payment_allocations pa
@@ -1078,25 +3623,8 @@ def view_receipt(payment_id):
             payment_date = payment['payment_date'].strftime('%d/%m/%Y')
             current_time = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
             
-            # Generate QR code with allocation details
-            allocation_details = "\n".join(
-                f"{alloc['term_name']}: {alloc['allocated']:.2f}" 
-                for alloc in term_balances
-            )
-            qr_data = f"""
-            Receipt: {payment['receipt_number']}
-            Student: {payment['student_name']} ({payment['admission_no']})
-            Total Paid: {float(payment['amount_paid']):.2f}
-            Allocation:
-            {allocation_details}
-            Cumulative Balance: {"+" if cumulative_balance > 0 else ""}{abs(cumulative_balance):.2f}
-            Date: {payment_date}
-            """
-            
-            qr_img = qrcode.make(qr_data)
-            qr_buffer = BytesIO()
-            qr_img.save(qr_buffer, format="PNG")
-            qr_b64 = base64.b64encode(qr_buffer.getvalue()).decode('utf-8')
+            # QR code links to the signed verification page
+            qr_b64 = make_qr_base64(verification_url('r', payment['id']))
             
             logo_base64 = get_logo_base64()
             
@@ -1114,25 +3642,29 @@ def view_receipt(payment_id):
         logger.error(f"Error in view_receipt: {str(e)}", exc_info=True)
         flash('Error generating receipt', 'danger')
         return redirect(url_for('view_payments'))
+OUTSTANDING_STUDENTS_QUERY = '''
+    SELECT 
+        s.id, s.name, s.admission_no, s.form,
+        sb.current_balance AS balance,
+        COUNT(obn.id) AS notices_count,
+        MAX(obn.due_date) AS latest_due_date
+    FROM students s
+    JOIN student_balances sb ON s.id = sb.student_id
+    LEFT JOIN outstanding_balance_notices obn
+        ON s.id = obn.student_id AND NOT obn.is_paid AND obn.escalated_at IS NULL
+    WHERE sb.current_balance > 0 AND s.deleted_at IS NULL
+    GROUP BY s.id, s.name, s.admission_no, s.form, sb.current_balance
+    ORDER BY sb.current_balance DESC
+'''
+
 @app.route('/outstanding')
 @login_required
+@conditional_get('students', 'balances', 'notices')
 def outstanding_balances():
     try:
         with get_db_cursor(dict_cursor=True) as cur:
             # Get students with outstanding balances
-            cur.execute('''
-                SELECT 
-                    s.id, s.name, s.admission_no, s.form,
-                    sb.current_balance AS balance,
-                    COUNT(obn.id) AS notices_count,
-                    MAX(obn.due_date) AS latest_due_date
-                FROM students s
-                JOIN student_balances sb ON s.id = sb.student_id
-                LEFT JOIN outstanding_balance_notices obn ON s.id = obn.student_id AND NOT obn.is_paid
-                WHERE sb.current_balance > 0
-                GROUP BY s.id, s.name, s.admission_no, s.form, sb.current_balance
-                ORDER BY sb.current_balance DESC
-            ''')
+            cur.execute(OUTSTANDING_STUDENTS_QUERY)
             students = cur.fetchall()
 
             # Calculate summary statistics
@@ -1143,8 +3675,9 @@ def outstanding_balances():
                     COUNT(obn.id) AS total_active_notices
                 FROM students s
                 JOIN student_balances sb ON s.id = sb.student_id
-                LEFT JOIN outstanding_balance_notices obn ON s.id = obn.student_id AND NOT obn.is_paid
-                WHERE sb.current_balance > 0
+                LEFT JOIN outstanding_balance_notices obn
+                    ON s.id = obn.student_id AND NOT obn.is_paid AND obn.escalated_at IS NULL
+                WHERE sb.current_balance > 0 AND s.deleted_at IS NULL
             ''')
             stats = cur.fetchone()
 
@@ -1159,6 +3692,268 @@ def outstanding_balances():
         return redirect(url_for('dashboard'))
 
 
+# Arrears aging
+# Payments settle a student's oldest charges first; each charge's unpaid part is
+# aged from its term's due date. One pass, rolled up per student, per form and overall.
+AGING_REPORT_SQL = f'''
+    WITH charges AS (
+        SELECT c.student_id, c.term_id, c.amount,
+               COALESCE(t.due_date, t.created_at::date) AS due_date
+        FROM ({STUDENT_CHARGES_SQL}) c
+        JOIN terms t ON t.id = c.term_id
+        WHERE c.amount > 0
+    ),
+    paid AS (
+        SELECT student_id, SUM(amount_paid) AS paid
+        FROM payments
+        WHERE payment_date <= %(as_of)s
+          AND term_id IN (SELECT id FROM terms WHERE NOT is_archived AND deleted_at IS NULL)
+        GROUP BY student_id
+    ),
+    open_items AS (
+        SELECT c.student_id,
+               %(as_of)s::date - c.due_date AS days_overdue,
+               LEAST(c.amount, GREATEST(
+                   SUM(c.amount) OVER (PARTITION BY c.student_id ORDER BY c.due_date, c.term_id)
+                   - COALESCE(p.paid, 0), 0)) AS outstanding
+        FROM charges c
+        LEFT JOIN paid p ON p.student_id = c.student_id
+    )
+    SELECT s.form, s.admission_no, s.name, o.student_id,
+           COALESCE(SUM(o.outstanding) FILTER (WHERE o.days_overdue < 0), 0) AS not_due,
+           COALESCE(SUM(o.outstanding) FILTER (WHERE o.days_overdue BETWEEN 0 AND 30), 0) AS days_0_30,
+           COALESCE(SUM(o.outstanding) FILTER (WHERE o.days_overdue BETWEEN 31 AND 60), 0) AS days_31_60,
+           COALESCE(SUM(o.outstanding) FILTER (WHERE o.days_overdue BETWEEN 61 AND 90), 0) AS days_61_90,
+           COALESCE(SUM(o.outstanding) FILTER (WHERE o.days_overdue > 90), 0) AS days_over_90,
+           SUM(o.outstanding) AS total,
+           GROUPING(s.form) AS is_grand_total,
+           GROUPING(o.student_id) AS is_form_total
+    FROM open_items o
+    JOIN students s ON s.id = o.student_id AND s.deleted_at IS NULL
+    GROUP BY GROUPING SETS ((s.form, o.student_id, s.admission_no, s.name), (s.form), ())
+    HAVING SUM(o.outstanding) > 0
+    ORDER BY GROUPING(s.form), s.form, GROUPING(o.student_id), s.admission_no
+'''
+AGING_BUCKETS = ['not_due', 'days_0_30', 'days_31_60', 'days_61_90', 'days_over_90', 'total']
+
+def aging_as_of(args):
+    value = args.get('as_of', '').strip()
+    return datetime.strptime(value, '%Y-%m-%d').date() if value else datetime.now().date()
+
+@app.route('/outstanding/aging')
+@login_required
+def aging_report():
+    try:
+        as_of = aging_as_of(request.args)
+    except ValueError:
+        flash('Invalid date format', 'danger')
+        return redirect(url_for('aging_report'))
+    try:
+        with get_db_cursor(dict_cursor=True) as cur:
+            cur.execute(AGING_REPORT_SQL, {'as_of': as_of})
+            rows = cur.fetchall()
+    except Exception as e:
+        logger.error(f"Error in aging_report: {str(e)}")
+        flash('Error computing aging report', 'danger')
+        return redirect(url_for('outstanding_balances'))
+
+    students = [row for row in rows if not row['is_form_total']]
+    forms = [row for row in rows if row['is_form_total'] and not row['is_grand_total']]
+    totals = next((row for row in rows if row['is_grand_total']), None)
+    return render_template('aging_report.html', students=students, forms=forms, totals=totals,
+                           as_of=as_of, buckets=AGING_BUCKETS)
+
+@app.route('/outstanding/aging.csv')
+@login_required
+def export_aging_report():
+    try:
+        as_of = aging_as_of(request.args)
+    except ValueError:
+        flash('Invalid date format', 'danger')
+        return redirect(url_for('aging_report'))
+
+    def generate():
+        buffer = StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(['Form', 'Admission No', 'Student', 'Not Yet Due', '0-30 Days', '31-60 Days',
+                         '61-90 Days', 'Over 90 Days', 'Total'])
+        with get_db_cursor(name='aging_export') as cur:
+            cur.execute(AGING_REPORT_SQL, {'as_of': as_of})
+            for row in cur:
+                if row[10]:
+                    label = ['ALL FORMS', '', 'Total']
+                elif row[11]:
+                    label = [row[0], '', 'Form total']
+                else:
+                    label = [row[0], row[1], row[2]]
+                writer.writerow(label + [f'{amount:.2f}' for amount in row[4:10]])
+                if buffer.tell() > 64 * 1024:
+                    yield buffer.getvalue()
+                    buffer.seek(0)
+                    buffer.truncate()
+        yield buffer.getvalue()
+
+    response = Response(stream_with_context(generate()), mimetype='text/csv')
+    response.headers['Content-Disposition'] = f'attachment; filename=aging_{as_of.strftime("%Y%m%d")}.csv'
+    return response
+
+# Balance snapshots
+SNAPSHOT_LOCK_ID = 4801
+SNAPSHOT_RETENTION_DAYS = int(os.getenv('SNAPSHOT_RETENTION_DAYS', 3650))
+
+def snapshot_balances(cur):
+    """Snapshot every non-zero open-term balance; returns (run id, rows), or None if today's run exists.
+
+    Balances come from the ledger (charges less journalled payments up to the
+    watermark) rather than term_balances, which may never have been refreshed
+    on an upgraded database.
+    """
+    cur.execute('SELECT pg_try_advisory_xact_lock(%s)', (SNAPSHOT_LOCK_ID,))
+    if not cur.fetchone()[0]:
+        return None
+    cur.execute('SELECT 1 FROM balance_snapshot_runs WHERE snapshot_date = CURRENT_DATE')
+    if cur.fetchone():
+        return None
+    # Wait out in-flight payment writes and hold new ones, so every journal event up to
+    # the recorded watermark is in the snapshot and none after it is
+    cur.execute('LOCK TABLE payment_events IN SHARE MODE')
+    cur.execute('''
+        INSERT INTO balance_snapshot_runs (snapshot_date, taken_at, last_event_id)
+        SELECT CURRENT_DATE, clock_timestamp(), COALESCE(MAX(id), 0) FROM payment_events
+        RETURNING id, last_event_id
+    ''')
+    run_id, last_event_id = cur.fetchone()
+    cur.execute(f'''
+        WITH charges AS ({STUDENT_CHARGES_SQL}),
+        paid AS (
+            SELECT student_id, term_id, SUM(amount) AS paid
+            FROM payment_events
+            WHERE id <= %(last_event_id)s
+            GROUP BY student_id, term_id
+        )
+        INSERT INTO balance_snapshots (run_id, student_id, term_id, balance)
+        SELECT %(run_id)s, c.student_id, c.term_id, c.amount - COALESCE(p.paid, 0)
+        FROM charges c
+        LEFT JOIN paid p ON p.student_id = c.student_id AND p.term_id = c.term_id
+        WHERE c.amount - COALESCE(p.paid, 0) <> 0
+    ''', {'run_id': run_id, 'last_event_id': last_event_id})
+    rows = cur.rowcount
+    cur.execute("DELETE FROM balance_snapshot_runs WHERE snapshot_date < CURRENT_DATE - %s * INTERVAL '1 day'",
+                (SNAPSHOT_RETENTION_DAYS,))
+    return run_id, rows
+
+def run_balance_snapshot():
+    with get_db_cursor(commit=True) as cur:
+        result = snapshot_balances(cur)
+    if result:
+        logger.info(f"Balance snapshot {result[0]}: {result[1]} balances")
+    return result
+
+# Nearest snapshot taken by the end of as_of, plus the journal events recorded after it.
+# level is GROUPING(form, student, term): 0 = student and term, 1 = student, 3 = form, 7 = all students.
+BALANCES_AS_OF_SQL = '''
+    WITH run AS (
+        SELECT id, last_event_id FROM balance_snapshot_runs
+        WHERE taken_at < %(as_of)s::date + 1
+        ORDER BY taken_at DESC
+        LIMIT 1
+    ),
+    combined AS (
+        SELECT bs.student_id, bs.term_id, bs.balance
+        FROM balance_snapshots bs
+        JOIN run ON bs.run_id = run.id
+        UNION ALL
+        SELECT e.student_id, e.term_id, -e.amount
+        FROM payment_events e
+        JOIN run ON e.id > run.last_event_id
+        WHERE e.recorded_at < %(as_of)s::date + 1
+    )
+    SELECT s.form, s.id AS student_id, s.admission_no, s.name, t.id AS term_id, t.name AS term_name,
+           SUM(c.balance) AS balance,
+           GROUPING(s.form, s.id, t.id) AS level
+    FROM combined c
+    JOIN students s ON s.id = c.student_id
+    LEFT JOIN terms t ON t.id = c.term_id
+    WHERE s.deleted_at IS NULL{filters}
+    GROUP BY GROUPING SETS ((s.form, s.id, s.admission_no, s.name, t.id, t.name),
+                            (s.form, s.id, s.admission_no, s.name), (s.form), ())
+    HAVING SUM(c.balance) <> 0 OR GROUPING(s.form) = 1
+    ORDER BY GROUPING(s.form), s.form, s.admission_no, GROUPING(s.id), GROUPING(t.id) DESC, t.id
+'''
+
+def balances_as_of(cur, as_of, form=None, admission_no=None):
+    """Balances owed at the end of as_of; returns (snapshot run or None, rows tagged with level)"""
+    cur.execute('''
+        SELECT id, snapshot_date, taken_at FROM balance_snapshot_runs
+        WHERE taken_at < %s::date + 1
+        ORDER BY taken_at DESC
+        LIMIT 1
+    ''', (as_of,))
+    run = cur.fetchone()
+    if not run:
+        return None, []
+    filters = ''
+    params = {'as_of': as_of}
+    if form:
+        filters += ' AND s.form = %(form)s'
+        params['form'] = form
+    if admission_no:
+        filters += ' AND s.admission_no = %(admission_no)s'
+        params['admission_no'] = admission_no
+    cur.execute(BALANCES_AS_OF_SQL.format(filters=filters), params)
+    return run, cur.fetchall()
+
+def balances_as_of_request(args):
+    """Parse the as-of filters shared by the page and the API"""
+    value = args.get('date', '').strip()
+    as_of = datetime.strptime(value, '%Y-%m-%d').date() if value else datetime.now().date()
+    return as_of, args.get('form', '').strip(), args.get('admission_no', '').strip()
+
+@app.route('/reports/balances-as-of')
+@login_required
+def balances_as_of_report():
+    try:
+        as_of, form, admission_no = balances_as_of_request(request.args)
+    except ValueError:
+        flash('Invalid date format', 'danger')
+        return redirect(url_for('balances_as_of_report'))
+    try:
+        with get_db_cursor(dict_cursor=True) as cur:
+            run, rows = balances_as_of(cur, as_of, form, admission_no)
+    except Exception as e:
+        logger.error(f"Error in balances_as_of_report: {str(e)}")
+        flash('Error computing balances', 'danger')
+        return redirect(url_for('outstanding_balances'))
+    if run is None:
+        flash(f'No balance snapshot was taken on or before {as_of.strftime("%d/%m/%Y")}', 'warning')
+    return render_template('balances_as_of.html', as_of=as_of, form=form, admission_no=admission_no, run=run,
+                           terms=[row for row in rows if row['level'] == 0],
+                           students=[row for row in rows if row['level'] == 1],
+                           forms=[row for row in rows if row['level'] == 3],
+                           total=next((row['balance'] for row in rows if row['level'] == 7), None))
+
+@app.route('/api/balances/as-of')
+@login_required
+def balances_as_of_api():
+    try:
+        as_of, form, admission_no = balances_as_of_request(request.args)
+    except ValueError:
+        return jsonify({'error': 'date must be YYYY-MM-DD'}), 400
+    with get_db_cursor(dict_cursor=True) as cur:
+        run, rows = balances_as_of(cur, as_of, form, admission_no)
+    if run is None:
+        return jsonify({'error': f'no snapshot on or before {as_of.isoformat()}'}), 404
+    return jsonify({
+        'as_of': as_of.isoformat(),
+        'snapshot_date': run['snapshot_date'].isoformat(),
+        'students': [{'student_id': row['student_id'], 'admission_no': row['admission_no'], 'name': row['name'],
+                      'form': row['form'], 'balance': str(row['balance'])}
+                     for row in rows if row['level'] == 1],
+        'terms': [{'student_id': row['student_id'], 'term_id': row['term_id'], 'term': row['term_name'],
+                   'balance': str(row['balance'])}
+                  for row in rows if row['level'] == 0]
+    })
+
 @app.route('/outstanding/student/<int:student_id>')
 @login_required
 def student_outstanding_details(student_id):
@@ -1171,7 +3966,7 @@ def student_outstanding_details(student_id):
                     sb.current_balance AS balance
                 FROM students s
                 JOIN student_balances sb ON s.id = sb.student_id
-                WHERE s.id = %s AND sb.current_balance > 0
+                WHERE s.id = %s AND sb.current_balance > 0 AND s.deleted_at IS NULL
             ''', (student_id,))
             student = cur.fetchone()
 
@@ -1195,7 +3990,7 @@ def student_outstanding_details(student_id):
             cur.execute('''
                 SELECT 
                     id, amount, issued_date, due_date, 
-                    reference_number, is_paid, paid_date
+                    reference_number, is_paid, paid_date, escalated_at
                 FROM outstanding_balance_notices
                 WHERE student_id = %s
                 ORDER BY issued_date DESC
@@ -1203,8 +3998,7 @@ def student_outstanding_details(student_id):
             notices = cur.fetchall()
 
             # Get term fees
-            cur.execute('SELECT id, name, amount FROM terms ORDER BY name')
-            terms = cur.fetchall()
+            terms = get_terms()
 
             return render_template('student_outstanding_details.html',
                                 student=student,
@@ -1223,13 +4017,13 @@ def student_outstanding_details(student_id):
 @login_required
 def generate_outstanding_notice(student_id):
     try:
-        with get_db_cursor(dict_cursor=True) as cur:
+        with get_db_cursor(dict_cursor=True, primary=True) as cur:
             # Verify student exists and has balance
             cur.execute('''
                 SELECT s.id, s.name, s.admission_no, sb.current_balance
                 FROM students s
                 JOIN student_balances sb ON s.id = sb.student_id
-                WHERE s.id = %s AND sb.current_balance > 0
+                WHERE s.id = %s AND sb.current_balance > 0 AND s.deleted_at IS NULL
             ''', (student_id,))
             student = cur.fetchone()
             
@@ -1241,7 +4035,7 @@ def generate_outstanding_notice(student_id):
             cur.execute('''
                 SELECT 1 
                 FROM outstanding_balance_notices
-                WHERE student_id = %s AND is_paid = FALSE
+                WHERE student_id = %s AND is_paid = FALSE AND escalated_at IS NULL
             ''', (student_id,))
             if cur.fetchone():
                 flash('This student already has an active outstanding notice', 'warning')
@@ -1302,18 +4096,8 @@ def view_outstanding_notice(notice_id):
                 flash('Notice not found', 'danger')
                 return redirect(url_for('outstanding_balances'))
 
-            # Generate QR code
-            qr_data = f"""Outstanding Balance Notice
-Reference: {notice['reference_number']}
-Student: {notice['student_name']} ({notice['admission_no']})
-Amount: KSh {float(notice['amount']):,.2f}
-Due Date: {notice['due_date'].strftime('%d/%m/%Y')}
-Status: {'PAID' if notice['is_paid'] else 'PENDING'}"""
-            
-            qr_img = qrcode.make(qr_data)
-            qr_buffer = BytesIO()
-            qr_img.save(qr_buffer, format="PNG")
-            qr_b64 = base64.b64encode(qr_buffer.getvalue()).decode('utf-8')
+            # QR code links to the signed verification page
+            qr_b64 = make_qr_base64(verification_url('n', notice['id']))
 
             return render_template('outstanding_notice.html',
                                 notice=notice,
@@ -1327,73 +4111,660 @@ Status: {'PAID' if notice['is_paid'] else 'PENDING'}"""
         return redirect(url_for('outstanding_balances'))
 
 
+NOTICE_PDF_QUERY = '''
+    SELECT 
+        obn.*,
+        s.name AS student_name,
+        s.admission_no,
+        s.form,
+        sb.current_balance
+    FROM outstanding_balance_notices obn
+    JOIN students s ON obn.student_id = s.id
+    JOIN student_balances sb ON s.id = sb.student_id
+    WHERE obn.id = %s
+'''
+
+def fetch_notice_for_pdf(notice_id):
+    with get_db_cursor(dict_cursor=True, primary=True) as cur:
+        cur.execute(NOTICE_PDF_QUERY, (notice_id,))
+        return cur.fetchone()
+
+def notice_pdf_path(notice):
+    """Cache file for a notice PDF; the name changes whenever the printed balance, status or date would"""
+    return os.path.join(NOTICE_PDF_DIR,
+                        f"{notice['id']}_{notice['current_balance']}_{int(bool(notice['is_paid']))}"
+                        f"_{datetime.now():%Y%m%d}.pdf")
+
+def render_notice_pdf(notice, base_url):
+    """Render an outstanding balance notice to PDF bytes"""
+    # Format dates and amounts
+    issued_date = notice['issued_date'].strftime('%d/%m/%Y')
+    due_date = notice['due_date'].strftime('%d/%m/%Y')
+    amount = float(notice['amount'])
+    current_balance = float(notice['current_balance'])
+    
+    with app.test_request_context('/', base_url=base_url):
+        # QR code links to the signed verification page
+        qr_b64 = make_qr_base64(verification_url('n', notice['id']))
+        html = render_template('outstanding_notice_pdf.html',
+                            notice=notice,
+                            issued_date=issued_date,
+                            due_date=due_date,
+                            amount=amount,
+                            current_balance=current_balance,
+                            qr_code=qr_b64,
+                            logo_base64=get_logo_base64(),
+                            current_date=datetime.now().strftime('%d/%m/%Y'))
+    return HTML(string=html, base_url=base_url).write_pdf()
+
+def write_notice_pdf(notice, pdf_bytes):
+    os.makedirs(NOTICE_PDF_DIR, exist_ok=True)
+    path = notice_pdf_path(notice)
+    with open(path + '.tmp', 'wb') as pdf_file:
+        pdf_file.write(pdf_bytes)
+    os.replace(path + '.tmp', path)
+    # Earlier renders of this notice are superseded
+    prune_notice_pdfs(lambda name: name.startswith(f"{notice['id']}_") and name != os.path.basename(path))
+
+def prune_notice_pdfs(stale=None):
+    """Delete cached notice PDFs matching stale(name); by default every file not rendered today"""
+    if stale is None:
+        today = f"_{datetime.now():%Y%m%d}.pdf"
+        stale = lambda name: not name.endswith(today)
+    try:
+        names = os.listdir(NOTICE_PDF_DIR)
+    except FileNotFoundError:
+        return 0
+    pruned = 0
+    for name in names:
+        if name.endswith(('.pdf', '.tmp')) and stale(name):
+            try:
+                os.remove(os.path.join(NOTICE_PDF_DIR, name))
+                pruned += 1
+            except OSError:
+                pass
+    return pruned
+
 @app.route('/outstanding/notice/<int:notice_id>/pdf')
 @login_required
 def outstanding_notice_pdf(notice_id):
     try:
-        with get_db_cursor(dict_cursor=True) as cur:
-            # Get notice details with student info
-            cur.execute('''
-                SELECT 
-                    obn.*,
-                    s.name AS student_name,
-                    s.admission_no,
-                    s.form,
-                    sb.current_balance
-                FROM outstanding_balance_notices obn
-                JOIN students s ON obn.student_id = s.id
-                JOIN student_balances sb ON s.id = sb.student_id
-                WHERE obn.id = %s
-            ''', (notice_id,))
-            notice = cur.fetchone()
-            
-            if not notice:
-                flash('Notice not found', 'danger')
-                return redirect(url_for('outstanding_balances'))
+        notice = fetch_notice_for_pdf(notice_id)
+        if not notice:
+            flash('Notice not found', 'danger')
+            return redirect(url_for('outstanding_balances'))
 
-            # Format dates and amounts
-            issued_date = notice['issued_date'].strftime('%d/%m/%Y')
-            due_date = notice['due_date'].strftime('%d/%m/%Y')
-            amount = float(notice['amount'])
-            current_balance = float(notice['current_balance'])
-            
-            # Generate QR code
-            qr_data = f"""Outstanding Balance Notice
-Reference: {notice['reference_number']}
-Student: {notice['student_name']} ({notice['admission_no']})
-Amount Due: KSh {amount:,.2f}
-Current Balance: KSh {current_balance:,.2f}
-Issued: {issued_date}
-Due: {due_date}
-Status: {'PAID' if notice['is_paid'] else 'PENDING'}"""
-            
-            qr_img = qrcode.make(qr_data)
-            qr_buffer = BytesIO()
-            qr_img.save(qr_buffer, format="PNG")
-            qr_b64 = base64.b64encode(qr_buffer.getvalue()).decode('utf-8')
-
-            # Generate PDF
-            html = render_template('outstanding_notice_pdf.html',
-                                notice=notice,
-                                issued_date=issued_date,
-                                due_date=due_date,
-                                amount=amount,
-                                current_balance=current_balance,
-                                qr_code=qr_b64,
-                                logo_base64=get_logo_base64(),
-                                current_date=datetime.now().strftime('%d/%m/%Y'))
-            
-            pdf_bytes = HTML(string=html, base_url=request.host_url).write_pdf()
-            
-            response = make_response(pdf_bytes)
-            response.headers['Content-Type'] = 'application/pdf'
-            response.headers['Content-Disposition'] = f'inline; filename=Outstanding_Balance_{notice["reference_number"]}.pdf'
-            return response
+        # Escalated notices are rendered overnight; anything else is rendered now and kept
+        path = notice_pdf_path(notice)
+        if os.path.exists(path):
+            with open(path, 'rb') as pdf_file:
+                pdf_bytes = pdf_file.read()
+        else:
+            pdf_bytes = render_notice_pdf(notice, request.host_url)
+            write_notice_pdf(notice, pdf_bytes)
+        
+        response = make_response(pdf_bytes)
+        response.headers['Content-Type'] = 'application/pdf'
+        response.headers['Content-Disposition'] = f'inline; filename=Outstanding_Balance_{notice["reference_number"]}.pdf'
+        return response
             
     except Exception as e:
         logger.error(f"Error generating PDF notice: {str(e)}", exc_info=True)
         flash('Error generating PDF notice', 'danger')
         return redirect(url_for('outstanding_balances'))
+
+# Notice escalation
+NOTICE_PDF_DIR = os.getenv('NOTICE_PDF_DIR', 'notice_pdfs')
+# Base URL for notices rendered outside a request; their QR codes link here, so it must be
+# the public address. Without it (or PUBLIC_BASE_URL) nothing is pre-rendered overnight.
+NOTICE_BASE_URL = os.getenv('NOTICE_BASE_URL', '') or (PUBLIC_BASE_URL + '/' if PUBLIC_BASE_URL else '')
+ESCALATION_DUE_DAYS = int(os.getenv('ESCALATION_DUE_DAYS', 7))
+ENABLE_SCHEDULER = os.getenv('ENABLE_SCHEDULER', '').lower() in ('1', 'true', 'yes')
+SCHEDULER_HOUR = int(os.getenv('SCHEDULER_HOUR', 2))
+SCHEDULER_POLL_SECONDS = int(os.getenv('SCHEDULER_POLL_SECONDS', 300))
+ESCALATION_LOCK_ID = 4001
+scheduler_thread = None
+
+def escalate_overdue_notices(cur):
+    """Supersede every overdue unpaid notice with an escalation notice; returns the new notice ids"""
+    cur.execute('''
+        WITH overdue AS (
+            UPDATE outstanding_balance_notices n
+            SET escalated_at = CURRENT_TIMESTAMP
+            FROM student_balances sb
+            JOIN students s ON s.id = sb.student_id AND s.deleted_at IS NULL
+            WHERE sb.student_id = n.student_id
+              AND NOT n.is_paid
+              AND n.escalated_at IS NULL
+              AND n.due_date < CURRENT_DATE
+              AND sb.current_balance > 0
+            RETURNING n.id, n.student_id, n.escalation_level, sb.current_balance
+        )
+        INSERT INTO outstanding_balance_notices
+            (student_id, amount, issued_date, due_date, reference_number, escalation_level, escalated_from)
+        SELECT student_id, current_balance, CURRENT_DATE, CURRENT_DATE + %s,
+               'OB-' || to_char(now(), 'YYYYMMDDHH24MISS') || '-' || student_id || '-E' || (escalation_level + 1),
+               escalation_level + 1, id
+        FROM overdue
+        RETURNING id
+    ''', (ESCALATION_DUE_DAYS,))
+    return [row[0] for row in cur.fetchall()]
+
+def prerender_notice_pdf(notice_id):
+    try:
+        notice = fetch_notice_for_pdf(notice_id)
+        if notice and not os.path.exists(notice_pdf_path(notice)):
+            write_notice_pdf(notice, render_notice_pdf(notice, NOTICE_BASE_URL))
+    except Exception as e:
+        logger.error(f"Error pre-rendering notice {notice_id}: {str(e)}", exc_info=True)
+
+def run_notice_escalation():
+    """Escalate overdue notices and queue their PDFs; returns (notice ids, futures), or None if another worker holds the job"""
+    with get_db_cursor(commit=True) as cur:
+        cur.execute('SELECT pg_try_advisory_xact_lock(%s)', (ESCALATION_LOCK_ID,))
+        if not cur.fetchone()[0]:
+            return None
+        notice_ids = escalate_overdue_notices(cur)
+    logger.info(f"Escalated {len(notice_ids)} overdue notices")
+    # PDFs from earlier days print an old date and are never served again
+    prune_notice_pdfs()
+    if not NOTICE_BASE_URL:
+        if notice_ids:
+            logger.warning("Neither NOTICE_BASE_URL nor PUBLIC_BASE_URL is set; escalation notices will be "
+                           "rendered on first view instead of overnight")
+        return notice_ids, []
+    futures = [pdf_executor.submit(prerender_notice_pdf, notice_id) for notice_id in notice_ids]
+    return notice_ids, futures
+
+def run_scheduler():
+    """Run the escalation and balance snapshot once a day, at SCHEDULER_HOUR, in whichever worker gets there first"""
+    last_run = None
+    while True:
+        now = datetime.now()
+        if now.hour == SCHEDULER_HOUR and last_run != now.date():
+            try:
+                run_notice_escalation()
+                last_run = now.date()
+            except Exception as e:
+                logger.error(f"Scheduled notice escalation failed: {str(e)}", exc_info=True)
+            try:
+                run_balance_snapshot()
+            except Exception as e:
+                logger.error(f"Scheduled balance snapshot failed: {str(e)}", exc_info=True)
+        time.sleep(SCHEDULER_POLL_SECONDS)
+
+def start_scheduler():
+    global scheduler_thread
+    if scheduler_thread is None:
+        scheduler_thread = threading.Thread(target=run_scheduler, name='scheduler', daemon=True)
+        scheduler_thread.start()
+
+if ENABLE_SCHEDULER:
+    start_scheduler()
+
+# Maintenance commands
+@app.cli.command('rebuild-rollups')
+def rebuild_rollups_command():
+    """Recompute the dashboard rollup tables from the payments table."""
+    with get_db_cursor(commit=True) as cur:
+        rebuild_rollups(cur)
+    click.echo("Dashboard rollups rebuilt")
+
+@app.cli.command('import-students')
+@click.argument('path')
+def import_students_command(path):
+    """Admit students in bulk from a CSV or Excel file."""
+    with open(path, 'rb') as stream:
+        rows = read_student_rows(path, stream)
+    imported_count, errors = import_students(rows)
+    for error in errors:
+        click.echo(f"Row {error['row']} ({error['admission_no']}): {error['error']}")
+    click.echo(f"Imported {imported_count} students, {len(errors)} rows rejected")
+
+@app.cli.command('rollover')
+@click.argument('closing_year')
+@click.argument('new_year')
+def rollover_command(closing_year, new_year):
+    """Close CLOSING_YEAR: promote forms, graduate leavers, carry balances into NEW_YEAR."""
+    summary = rollover_academic_year(closing_year, new_year)
+    if summary is None:
+        click.echo(f"Academic year {closing_year} has already been closed")
+        return
+    for key, value in summary.items():
+        click.echo(f"{key}: {value}")
+
+@app.cli.command('replay-journal')
+@click.option('--check', is_flag=True, help='Only report term balances where the journal and payments disagree.')
+def replay_journal_command(check):
+    """Rebuild term and student balances from the payment_events journal."""
+    if check:
+        with get_db_cursor(primary=True) as cur:
+            ledger = ' UNION ALL '.join(f'SELECT student_id, term_id, amount_paid FROM {table}'
+                                        for table in payment_ledger_tables(cur))
+            cur.execute(f'''
+                WITH journal AS (
+                    SELECT student_id, term_id, SUM(amount) AS paid FROM payment_events GROUP BY student_id, term_id
+                ),
+                ledger AS (
+                    SELECT student_id, term_id, SUM(amount_paid) AS paid FROM ({ledger}) l GROUP BY student_id, term_id
+                )
+                SELECT student_id, term_id, COALESCE(j.paid, 0), COALESCE(l.paid, 0)
+                FROM journal j
+                FULL JOIN ledger l USING (student_id, term_id)
+                WHERE COALESCE(j.paid, 0) <> COALESCE(l.paid, 0)
+                ORDER BY student_id, term_id
+            ''')
+            mismatches = cur.fetchall()
+        for student_id, term_id, journal_paid, ledger_paid in mismatches:
+            click.echo(f"Student {student_id}, term {term_id}: journal {journal_paid}, payments {ledger_paid}")
+        click.echo(f"{len(mismatches)} mismatched term balances")
+        if mismatches:
+            sys.exit(1)
+        return
+    with get_db_cursor(commit=True) as cur:
+        refresh_term_balances(cur, from_journal=True)
+        refresh_student_balances(cur)
+    invalidate_dashboard_cache()
+    click.echo("Balances rebuilt from the payment journal")
+
+@app.cli.command('escalate-notices')
+def escalate_notices_command():
+    """Escalate overdue unpaid notices and pre-render their PDFs (for cron)."""
+    result = run_notice_escalation()
+    if result is None:
+        click.echo("Another worker is already escalating notices")
+        return
+    notice_ids, futures = result
+    for future in futures:
+        future.result()
+    if notice_ids and not futures:
+        click.echo(f"Escalated {len(notice_ids)} notices; set PUBLIC_BASE_URL to pre-render their PDFs")
+        return
+    click.echo(f"Escalated {len(notice_ids)} notices; PDFs written to {NOTICE_PDF_DIR}")
+
+@app.cli.command('snapshot-balances')
+def snapshot_balances_command():
+    """Write today's balance snapshot (for cron when the in-app scheduler is off)."""
+    result = run_balance_snapshot()
+    if result is None:
+        click.echo("Today's snapshot already exists")
+        return
+    click.echo(f"Snapshot {result[0]}: {result[1]} balances")
+
+@app.cli.command('sync-offline')
+def sync_offline_command():
+    """Push payments queued on the offline desk and refresh its student and term lists."""
+    init_offline_db()
+    totals = sync_offline()
+    with get_local_cursor() as cur:
+        cur.execute('''
+            SELECT receipt_number, sync_error FROM payments
+            WHERE sync_error IS NOT NULL AND synced_at IS NULL
+            ORDER BY id
+        ''')
+        for receipt_number, error in cur.fetchall():
+            click.echo(f"Conflict {receipt_number}: {error}")
+    click.echo(f"Synced {totals['synced']}, already recorded {totals['duplicate']}, conflicts {totals['conflict']}")
+
+@app.cli.command('settle-notices')
+def settle_notices_command():
+    """Mark every unpaid notice paid where the student's balance has cleared."""
+    with get_db_cursor(commit=True) as cur:
+        settled = settle_notices(cur)
+    click.echo(f"Settled {settled} notices")
+
+@app.cli.command('stress-balances')
+@click.option('--workers', default=8, help='Parallel posters; must stay below the pool size.')
+@click.option('--payments', default=50, help='Payments each worker posts.')
+@click.option('--students', default=2, help='Students the payments are spread over.')
+@click.option('--hold-ms', default=5, help='How long each payment keeps its transaction open after posting.')
+@click.option('--without-locks', is_flag=True, help='Disable the balance locks; the run should then FAIL.')
+@click.option('--i-know-this-writes', 'confirmed', is_flag=True,
+              help='Confirm the target database may be written to.')
+def stress_balances_command(workers, payments, students, hold_ms, without_locks, confirmed):
+    """Post payments from parallel workers against a bulk refresher and check every balance comes out exact.
+
+    A refresher thread keeps recomputing the same students' balances, the way
+    term edits do, while the payments land. Without the balance locks its
+    upserts overwrite payments from an older snapshot and the check fails.
+
+    Creates and then deletes its own term and students; the term is charged to
+    the stress students only. The journal keeps the payment/reversal pairs for
+    good, so run it against a staging database.
+    """
+    if not confirmed:
+        click.echo("stress-balances posts real payments and leaves them in the journal; "
+                   "point DATABASE_URL at a staging database and pass --i-know-this-writes")
+        sys.exit(1)
+    # The refresher needs a connection of its own too
+    if workers + 1 >= db_pool.maxconn:
+        click.echo(f"--workers must be below the pool size less one ({db_pool.maxconn - 1})")
+        sys.exit(1)
+    tag = uuid.uuid4().hex[:8]
+    term_amount = Decimal('1000000')
+    with get_db_cursor(commit=True) as cur:
+        # An opening-balance term charges nobody by default; the overrides below charge the stress students
+        cur.execute('''
+            INSERT INTO terms (name, amount, is_opening_balance) VALUES (%s, %s, TRUE) RETURNING id
+        ''', (f'Stress {tag}', term_amount))
+        term_id = cur.fetchone()[0]
+        cur.execute('''
+            INSERT INTO students (admission_no, name, form)
+            SELECT 'STRESS-' || %s || '-' || g, 'Stress Student ' || g, 'Stress'
+            FROM generate_series(1, %s) g
+            RETURNING id
+        ''', (tag, students))
+        student_ids = [row[0] for row in cur.fetchall()]
+        cur.execute('''
+            INSERT INTO student_term_charges (student_id, term_id, amount)
+            SELECT student_id, %s, %s FROM unnest(%s::int[]) AS student_id
+        ''', (term_id, term_amount, student_ids))
+        rebalance_students(cur, student_ids)
+        cur.execute('SELECT student_id, current_balance FROM student_balances WHERE student_id = ANY(%s)',
+                    (student_ids,))
+        opening = dict(cur.fetchall())
+    invalidate_term_cache()
+
+    def post(worker):
+        posted = Counter()
+        for n in range(payments):
+            student_id = student_ids[(worker + n) % len(student_ids)]
+            with get_db_cursor(commit=True) as cur:
+                record_payment(cur, student_id, term_id, Decimal('1.00'), datetime.now().date())
+                # A slow receipt print: the payment's rows stay locked and uncommitted a little longer
+                cur.execute('SELECT pg_sleep(%s)', (hold_ms / 1000,))
+            posted[student_id] += 1
+        return posted
+
+    posting = threading.Event()
+    posting.set()
+
+    def refresh():
+        refreshes = 0
+        while posting.is_set():
+            with get_db_cursor(commit=True) as cur:
+                rebalance_students(cur, student_ids)
+            refreshes += 1
+        return refreshes
+
+    locking = lock_student_balances
+    if without_locks:
+        globals()['lock_student_balances'] = lambda cur, student_ids=None: None
+    started = time.perf_counter()
+    posted = Counter()
+    refreshes = 0
+    failures = 0
+    try:
+        try:
+            with ThreadPoolExecutor(max_workers=workers + 1) as executor:
+                refresher = executor.submit(refresh)
+                try:
+                    for result in executor.map(post, range(workers)):
+                        posted.update(result)
+                finally:
+                    posting.clear()
+                refreshes = refresher.result()
+        except psycopg2.Error as e:
+            # Unlocked writers also deadlock on each other's balance rows
+            failures += 1
+            click.echo(f"FAIL writers aborted: {str(e).splitlines()[0]}")
+        finally:
+            globals()['lock_student_balances'] = locking
+        elapsed = time.perf_counter() - started
+
+        if not failures:
+            with get_db_cursor(primary=True) as cur:
+                for student_id in student_ids:
+                    cur.execute('''
+                        SELECT sb.current_balance, tb.balance
+                        FROM student_balances sb
+                        JOIN term_balances tb ON tb.student_id = sb.student_id AND tb.term_id = %s
+                        WHERE sb.student_id = %s
+                    ''', (term_id, student_id))
+                    current_balance, term_balance = cur.fetchone()
+                    expected_current = opening[student_id] - posted[student_id]
+                    expected_term = term_amount - posted[student_id]
+                    ok = current_balance == expected_current and term_balance == expected_term
+                    failures += not ok
+                    click.echo(f"{'ok  ' if ok else 'FAIL'} student {student_id}: {posted[student_id]} payments, "
+                               f"term balance {term_balance} (expected {expected_term}), "
+                               f"balance {current_balance} (expected {expected_current})")
+    finally:
+        with get_db_cursor(commit=True) as cur:
+            for student_id in student_ids:
+                delete_student_records(cur, student_id)
+            delete_term_records(cur, term_id)
+        invalidate_term_cache()
+        invalidate_dashboard_cache()
+
+    total = sum(posted.values())
+    click.echo(f"{total} payments from {workers} workers against {refreshes} bulk refreshes "
+               f"in {elapsed:.2f}s ({total / elapsed:.0f}/s)")
+    if failures:
+        sys.exit(1)
+
+@app.cli.command('bench-prepared')
+@click.option('--iterations', default=200, help='Executions of each statement per mode.')
+def bench_prepared_command(iterations):
+    """Compare plain and prepared execution of the hot statements.
+
+    Runs inside a transaction that is rolled back, so the balance upserts
+    leave no trace. Planning times come from EXPLAIN ANALYZE.
+    """
+    with get_db_cursor(primary=True) as cur:
+        conn = cur.connection
+        if not conn.prepare_enabled:
+            click.echo(f"Prepared statements are disabled for this connection (DB_PREPARE_MODE={DB_PREPARE_MODE})")
+            sys.exit(1)
+        cur.execute('''
+            SELECT p.id, p.student_id, p.term_id, s.admission_no
+            FROM payments p JOIN students s ON s.id = p.student_id
+            ORDER BY p.id DESC LIMIT 1
+        ''')
+        sample = cur.fetchone()
+        if not sample:
+            click.echo("Need at least one payment to benchmark")
+            sys.exit(1)
+        payment_id, student_id, term_id, admission_no = sample
+        cases = [
+            ('student lookup', STUDENT_LOOKUP_SQL, (admission_no, f'%{admission_no}%')),
+            ('per-term SUM + upsert', *term_balances_sql([student_id])),
+            ('balance read-back', RECORDED_BALANCES_SQL, {'student_id': student_id, 'term_id': term_id}),
+            ('receipt fetch', RECEIPT_PAYMENT_SQL.format(source='payments'), (payment_id,)),
+        ]
+
+        def planning_ms(sql, params):
+            cur.execute('EXPLAIN (ANALYZE, SUMMARY, FORMAT JSON) ' + sql, params)
+            return cur.fetchone()[0][0]['Planning Time']
+
+        try:
+            click.echo(f"{'statement':<24}{'plain ms':>10}{'prepared ms':>13}{'plan ms':>10}{'prep plan ms':>14}")
+            for label, sql, params in cases:
+                started = time.perf_counter()
+                for _ in range(iterations):
+                    cur.execute(sql, params)
+                plain = (time.perf_counter() - started) * 1000 / iterations
+
+                name, values = prepare_statement(cur, sql, params)
+                started = time.perf_counter()
+                for _ in range(iterations):
+                    execute_prepared(cur, sql, params)
+                prepared = (time.perf_counter() - started) * 1000 / iterations
+
+                plain_plan = planning_ms(sql, params)
+                prepared_plan = planning_ms(execute_sql(name, values), values)
+                click.echo(f"{label:<24}{plain:>10.3f}{prepared:>13.3f}{plain_plan:>10.3f}{prepared_plan:>14.3f}")
+        finally:
+            conn.rollback()
+
+@app.cli.command('purge-submissions')
+def purge_submissions_command():
+    """Forget payment submission tokens older than SUBMISSION_TOKEN_DAYS."""
+    with get_db_cursor(commit=True) as cur:
+        cur.execute("DELETE FROM payment_submissions WHERE created_at < CURRENT_TIMESTAMP - %s * INTERVAL '1 day'",
+                    (SUBMISSION_TOKEN_DAYS,))
+        purged = cur.rowcount
+    click.echo(f"Purged {purged} payment submission tokens")
+
+@app.cli.command('purge-deleted')
+def purge_deleted_command():
+    """Hard-delete students and terms that were soft-deleted (run off-hours)."""
+    purged = purge_deleted()
+    click.echo(f"Purged {purged['students']} students and {purged['terms']} terms")
+
+@app.cli.command('partition-payments')
+def partition_payments_command():
+    """Convert payments into yearly partitions on payment_date (safe to re-run)."""
+    with get_db_cursor(commit=True) as cur:
+        if payments_partitioned(cur):
+            click.echo("payments is already partitioned")
+            return
+        moved = partition_payments(cur)
+    click.echo(f"Partitioned payments: moved {moved} rows")
+
+@app.cli.command('archive-payments')
+@click.argument('before_year', type=int)
+def archive_payments_command(before_year):
+    """Detach payment partitions older than BEFORE_YEAR into payments_archive."""
+    with get_db_cursor(commit=True) as cur:
+        if not payments_partitioned(cur):
+            click.echo("payments is not partitioned; run 'flask partition-payments' first")
+            return
+        archived = archive_payment_partitions(cur, before_year)
+    click.echo(f"Archived payment years: {', '.join(map(str, archived)) or 'none'}")
+
+# Query plan verification: hot query shapes and the table each must reach through an index
+PLAN_CHECKS = [
+    ('per-term payment sum', 'payments',
+     'SELECT COALESCE(SUM(amount_paid), 0) FROM payments WHERE student_id = %s AND term_id = %s', (-5, -3)),
+    ('student payments by term', 'payments',
+     'SELECT term_id, SUM(amount_paid) FROM payments WHERE student_id = ANY(%s) GROUP BY term_id', ([-5, -10],)),
+    ('outstanding balances: owing students', 'student_balances', OUTSTANDING_STUDENTS_QUERY, ()),
+    ('outstanding balances: unpaid notices', 'outstanding_balance_notices', OUTSTANDING_STUDENTS_QUERY, ()),
+    ('open notice check', 'outstanding_balance_notices',
+     'SELECT 1 FROM outstanding_balance_notices WHERE student_id = %s AND is_paid = FALSE AND escalated_at IS NULL',
+     (-5,)),
+    ('term delete: term_balances', 'term_balances', 'DELETE FROM term_balances WHERE term_id = %s', (-3,)),
+    ('term delete: payment_allocations', 'payment_allocations',
+     'DELETE FROM payment_allocations WHERE term_id = %s', (-3,)),
+]
+PLAN_SEED_STUDENTS = 2000
+PLAN_SEED_TERMS = 24
+
+def seed_plan_dataset(cur):
+    """Insert a school-sized dataset under negative ids so no sequences are consumed"""
+    students, terms = PLAN_SEED_STUDENTS, PLAN_SEED_TERMS
+    cur.execute('''
+        INSERT INTO students (id, admission_no, name, form)
+        SELECT -g, 'PLAN-' || g, 'Plan Student ' || g, 'Form ' || (1 + g %% 4)
+        FROM generate_series(1, %s) g
+    ''', (students,))
+    cur.execute('''
+        INSERT INTO terms (id, name, amount)
+        SELECT -g, 'Plan Term ' || g, 10000 FROM generate_series(1, %s) g
+    ''', (terms,))
+    # Waive the real terms for seeded students so their balances don't depend on what the database holds
+    cur.execute('''
+        INSERT INTO student_term_charges (student_id, term_id, amount)
+        SELECT -g, t.id, 0 FROM generate_series(1, %s) g, terms t WHERE t.id > 0
+    ''', (students,))
+    # One payment per student and term; every fiftieth student is short and owes money, few
+    # enough that reading the owing students through the partial index is clearly cheapest
+    cur.execute('''
+        INSERT INTO payments (id, student_id, term_id, amount_paid, payment_date, receipt_number)
+        SELECT -(s * 100 + t), -s, -t, CASE WHEN s %% 50 = 0 THEN 7500 ELSE 10000 END,
+               CURRENT_DATE, 'PLAN-' || s || '-' || t
+        FROM generate_series(1, %s) s, generate_series(1, %s) t
+    ''', (students, terms))
+    cur.execute('''
+        INSERT INTO payment_allocations (payment_id, term_id, amount)
+        SELECT id, term_id, amount_paid FROM payments WHERE id < 0
+    ''')
+    rebalance_students(cur, list(range(-students, 0)))
+    # Mostly settled notices, the latest one still open
+    cur.execute('''
+        INSERT INTO outstanding_balance_notices
+            (id, student_id, amount, issued_date, due_date, reference_number, is_paid)
+        SELECT -(s * 10 + n), -s, 2500, CURRENT_DATE, CURRENT_DATE + 30, 'PLAN-' || s || '-' || n, n < 5
+        FROM generate_series(1, %s) s, generate_series(1, 5) n
+    ''', (students,))
+    for table in ('students', 'terms', 'payments', 'payment_allocations', 'term_balances',
+                  'student_balances', 'outstanding_balance_notices'):
+        cur.execute(f'ANALYZE {table}')
+
+def plan_scans(node, found=None):
+    """Map each relation in an EXPLAIN JSON plan to the scan node types that read it"""
+    found = {} if found is None else found
+    if 'Relation Name' in node:
+        found.setdefault(node['Relation Name'], set()).add(node['Node Type'])
+    for child in node.get('Plans', []):
+        plan_scans(child, found)
+    return found
+
+def relation_uses_index(scans, relation, seeded_relations):
+    """True when relation (or its partitions holding seeded rows) is read only through index-driven scans"""
+    relation_pattern = re.compile(rf'{relation}(_y\d{{4}}|_default)?')
+    types = set()
+    for name, node_types in scans.items():
+        if relation_pattern.fullmatch(name) and (name == relation or name in seeded_relations):
+            types |= node_types
+    index_types = {'Index Scan', 'Index Only Scan', 'Bitmap Heap Scan'}
+    return bool(types & index_types) and 'Seq Scan' not in types
+
+@app.cli.command('verify-plans')
+def verify_plans_command():
+    """Seed data in a rolled-back transaction and check hot queries use index scans."""
+    failures = 0
+    with get_db_cursor(primary=True) as cur:
+        try:
+            seed_plan_dataset(cur)
+            # Only the partitions holding seeded rows are judged; a seq scan of a small
+            # partition of real rows is the right plan at that size
+            cur.execute('SELECT DISTINCT tableoid::regclass::text FROM payments WHERE id < 0')
+            seeded_relations = {name for (name,) in cur.fetchall()}
+            for label, relation, sql, params in PLAN_CHECKS:
+                cur.execute(f'EXPLAIN (FORMAT JSON) {sql}', params)
+                plan = cur.fetchone()[0][0]['Plan']
+                scans = plan_scans(plan)
+                ok = relation_uses_index(scans, relation, seeded_relations)
+                failures += not ok
+                detail = ', '.join(f"{name}: {'/'.join(sorted(types))}" for name, types in sorted(scans.items()))
+                click.echo(f"{'ok  ' if ok else 'FAIL'} {label} ({detail})")
+        finally:
+            cur.connection.rollback()
+    if failures:
+        click.echo(f"{failures} of {len(PLAN_CHECKS)} plan checks failed")
+        sys.exit(1)
+    click.echo(f"All {len(PLAN_CHECKS)} plan checks passed")
+
+# Diagnostics
+@app.route('/admin/slow-queries')
+@admin_required
+def view_slow_queries():
+    """Most recent slow statements, newest first"""
+    return jsonify(list(reversed(slow_queries)))
+
+@app.route('/admin/profiles')
+@admin_required
+def view_profiles():
+    return render_template('profiles.html', profiles=list_profiles())
+
+@app.route('/admin/profiles/<name>')
+@admin_required
+def view_profile(name):
+    if not re.fullmatch(r'[\w.-]+', name):
+        flash('Invalid profile name', 'danger')
+        return redirect(url_for('view_profiles'))
+    try:
+        with open(os.path.join(PROFILE_DIR, name + '.json')) as meta_file:
+            profile = json.load(meta_file)
+        with open(os.path.join(PROFILE_DIR, name + '.txt')) as report:
+            call_tree = report.read()
+    except (OSError, ValueError):
+        flash('Profile not found', 'danger')
+        return redirect(url_for('view_profiles'))
+    return render_template('profiles.html', profiles=[profile], call_tree=call_tree)
+
 if __name__ == '__main__':
     try:
         port = int(os.environ.get('FLASK_PORT', 5000))